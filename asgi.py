@@ -0,0 +1,372 @@
+"""Async (ASGI) serving mode for the machine-facing order and serial endpoints.
+
+Serves the same payloads as OrderResource, OrderResourceRoute, SerialNumberResource and
+EventStream, but every handler is a coroutine, so a worker holds thousands of pending polls
+and event streams while waiting on the database. Run it next to the WSGI app, e.g.:
+
+    uvicorn asgi:application --workers 2
+
+With SQLAlchemy >= 1.4 the queries go through an async engine (aiomysql, or aiosqlite
+locally); on older SQLAlchemy they run on a small thread pool instead.
+"""
+import asyncio
+import datetime
+import functools
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+import sqlalchemy
+from flask_jwt_extended import decode_token
+from run import app
+from models import UserModel, MenuModel, OrderModel, AssociationModel, SerialNumberModel, is_token_revoked
+from resources import order_cache, order_line, order_payload, shows_obsolete, serial_payload, serial_link_payload
+import events
+
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:
+    create_async_engine = None
+
+
+logger = logging.getLogger(__name__)
+
+user_table = UserModel.__table__
+menu_table = MenuModel.__table__
+order_table = OrderModel.__table__
+association_table = AssociationModel.__table__
+serial_table = SerialNumberModel.__table__
+
+if app.config.get('ORDER_SHARDS'):
+    raise RuntimeError('asgi.py reads orders from the main database only; it does not support ORDER_SHARDS')
+
+ASYNC_DRIVERS = {'mysql': 'mysql+aiomysql', 'sqlite': 'sqlite+aiosqlite'}
+
+
+class HTTPError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class AsyncDatabase:
+    """Runs Core statements on an async engine, or on a thread pool when none is available."""
+
+    def __init__(self, config):
+        self.config = config
+        self.engine = None
+        self.executor = None
+
+    def _async_uri(self):
+        uri = self.config.get('ASYNC_DATABASE_URI')
+        if uri:
+            return uri
+        scheme, _, rest = self.config['SQLALCHEMY_DATABASE_URI'].partition('://')
+        return '{}://{}'.format(ASYNC_DRIVERS.get(scheme, scheme), rest)
+
+    def _connect(self):
+        pool_size = self.config.get('ASYNC_DB_POOL_SIZE', 10)
+        if create_async_engine is not None:
+            self.engine = create_async_engine(self._async_uri(), pool_recycle=3600)
+        else:
+            self.engine = sqlalchemy.create_engine(self.config['SQLALCHEMY_DATABASE_URI'], pool_recycle=3600)
+            self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='asgi-db')
+
+    async def execute(self, statement, write=False):
+        if self.engine is None:
+            self._connect()
+
+        if self.executor is None:
+            if write:
+                async with self.engine.begin() as conn:
+                    return (await conn.execute(statement)).rowcount
+            async with self.engine.connect() as conn:
+                return (await conn.execute(statement)).fetchall()
+
+        def run():
+            with self.engine.begin() as conn:
+                result = conn.execute(statement)
+                return result.rowcount if write else result.fetchall()
+
+        return await asyncio.get_event_loop().run_in_executor(self.executor, run)
+
+    async def first(self, statement):
+        rows = await self.execute(statement.limit(1))
+        return rows[0] if rows else None
+
+    async def dispose(self):
+        if self.engine is None:
+            return
+        if self.executor is None:
+            await self.engine.dispose()
+        else:
+            self.engine.dispose()
+            self.executor.shutdown(wait=False)
+        self.engine = None
+
+
+database = AsyncDatabase(app.config)
+
+
+def _revoked(decoded):
+    # the blacklist check of run.py, on the Flask-SQLAlchemy session of an executor thread
+    with app.app_context():
+        return is_token_revoked(decoded)
+
+
+async def current_username(scope, token_type='access'):
+    """Same checks as @jwt_required: signature, expiry, token type and the blacklist."""
+    header = dict(scope['headers']).get(b'authorization', b'').decode('latin-1')
+    prefix = app.config.get('JWT_HEADER_TYPE', 'Bearer')
+    if not header.startswith(prefix + ' '):
+        raise HTTPError('Missing Authorization Header', 401)
+
+    try:
+        with app.app_context():
+            decoded = decode_token(header[len(prefix) + 1:])
+    except Exception as e:
+        raise HTTPError(str(e) or 'Invalid token', 422)
+
+    if decoded.get('type') != token_type:
+        raise HTTPError('Only {} tokens are allowed'.format(token_type), 422)
+
+    username = decoded[app.config.get('JWT_IDENTITY_CLAIM', 'identity')]
+    if await asyncio.get_event_loop().run_in_executor(None, _revoked, decoded):
+        raise HTTPError('Token has been revoked', 401)
+
+    return username
+
+
+async def publish(event_type, user_id, **data):
+    # a Redis broker publishes over the network, which must not block the loop
+    await asyncio.get_event_loop().run_in_executor(
+        None, functools.partial(events.publish, event_type, user_id=user_id, **data))
+
+
+def _order_date(value):
+    # async sqlite drivers hand DATETIME columns back as strings
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value
+
+
+async def _order_contents(order_ids):
+    statement = sqlalchemy.select([association_table.c.order_id, association_table.c.counts, menu_table]) \
+        .select_from(association_table.join(menu_table, association_table.c.menu_id == menu_table.c.id)) \
+        .where(association_table.c.order_id.in_(order_ids))
+
+    contents = {order_id: list() for order_id in order_ids}
+    for row in await database.execute(statement):
+        contents[row.order_id].append(order_line(row, row.counts))
+    return contents
+
+
+async def order_detail(scope, params, body, order_id):
+    order = await database.first(order_table.select().where(order_table.c.id == order_id))
+    if order is None:
+        return {'message': 'order not found'}, 404
+    if shows_obsolete(order.id, order.is_obsolete):
+        return {'message': 'order was obsoleted'}, 400
+
+    contents = await _order_contents([order.id])
+    return order_payload(order.id, _order_date(order.create_date), contents[order.id]), 200
+
+
+async def order_obsolete(scope, params, body, order_id):
+    order = await database.first(sqlalchemy.select([order_table.c.user_id]).where(order_table.c.id == order_id))
+    if order is None:
+        return {'message': 'user not found'}, 404
+    await database.execute(order_table.update().where(order_table.c.id == order_id)
+                           .values(is_obsolete=True), write=True)
+    # reaches the WSGI workers through a shared ORDER_CACHE backend, otherwise ORDER_CACHE_TTL bounds it
+    await asyncio.get_event_loop().run_in_executor(None, order_cache.delete, order_id)
+    await publish('order.obsoleted', user_id=order.user_id, order_id=order_id)
+    return {'order_id': order_id, 'is_obsoleted': True}, 200
+
+
+async def order_list(scope, params, body):
+    username = await current_username(scope)
+    user = await database.first(user_table.select().where(user_table.c.username == username))
+    orders = await database.execute(order_table.select().where(sqlalchemy.and_(
+        order_table.c.user_id == user.id, order_table.c.is_obsolete == sqlalchemy.false())))
+
+    contents = await _order_contents([order.id for order in orders]) if orders else {}
+    return [order_payload(order.id, _order_date(order.create_date), contents[order.id]) for order in orders], 200
+
+
+async def serial_lookup(scope, params, body):
+    await current_username(scope)
+    order_id = params.get('order_id')
+    serial_number = params.get('serial_number')
+
+    if order_id:
+        if not order_id.isdigit():
+            raise HTTPError('order_id: Not a valid integer.', 422)
+        order = await database.first(order_table.select().where(order_table.c.id == int(order_id)))
+        if order is None:
+            return {'message': 'order_id not found'}, 404
+        serials = await database.execute(serial_table.select().where(serial_table.c.order_id == order.id))
+        return [serial_link_payload(item.serial_number, item.menu_id, item.order_id) for item in serials], 200
+    elif serial_number:
+        statement = sqlalchemy.select([serial_table.c.serial_number, order_table.c.customized_message]) \
+            .select_from(serial_table.join(order_table, serial_table.c.order_id == order_table.c.id)) \
+            .where(serial_table.c.serial_number == serial_number)
+        serial = await database.first(statement)
+        if serial is None:
+            return {'message': 'serial_number not found'}, 404
+        return serial_payload(serial.serial_number, serial.customized_message), 200
+    else:
+        return {'message': 'order or serial is required.'}, 400
+
+
+async def serial_link(scope, params, body):
+    if not body.get('serial_number'):
+        raise HTTPError('serial_number: Missing data for required field.', 422)
+    values = {'order_id': body.get('order_id'), 'menu_id': body.get('menu_id'),
+              'serial_number': body['serial_number']}
+
+    order = await database.first(sqlalchemy.select([order_table.c.user_id])
+                                 .where(order_table.c.id == values['order_id']))
+    if order is None:
+        return {"message": "link failed", "reason": "order not found"}, 200
+
+    duplicated = await database.first(serial_table.select().where(sqlalchemy.and_(
+        *[serial_table.c[key] == value for key, value in values.items()])))
+    if duplicated is not None:
+        return {"message": "link failed", "reason": "duplicated link information"}, 200
+
+    try:
+        await database.execute(serial_table.insert().values(create_date=datetime.datetime.utcnow(), **values),
+                               write=True)
+    except Exception:
+        logger.exception("link serial failed")
+        return {"message": "link failed", "reason": "exception raised."}, 200
+
+    await publish('serial_number.linked', user_id=order.user_id, **values)
+    return {"message": "link serial success."}, 200
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def event_stream(scope, receive, send, params):
+    """Server-sent events as in EventStream; ends after max_duration or when the client leaves."""
+    username = await current_username(scope)
+    topics = params.get('topics', ','.join(events.TOPICS)).split(',')
+    for topic in topics:
+        if topic not in events.TOPICS:
+            raise HTTPError('topics: Must be one of: {}.'.format(', '.join(events.TOPICS)), 422)
+    user = await database.first(sqlalchemy.select([user_table.c.id]).where(user_table.c.username == username))
+
+    loop = asyncio.get_event_loop()
+    subscription = events.subscribe(user_id=user.id, topics=topics, loop=loop)
+    disconnected = asyncio.ensure_future(_disconnected(receive))
+    heartbeat = app.config.get('EVENT_HEARTBEAT_SECONDS', 15)
+    deadline = loop.time() + app.config.get('EVENT_STREAM_SECONDS', 300)
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+        while loop.time() < deadline:
+            getter = asyncio.ensure_future(subscription.get(timeout=heartbeat))
+            await asyncio.wait({getter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                getter.cancel()
+                return
+            event = getter.result()
+            chunk = events.format_event(event) if event is not None else ': keep-alive\n\n'
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        events.hub.unsubscribe(subscription)
+
+
+routes = [
+    (re.compile(r'^/order/(?P<order_id>\d+)$'), {'GET': order_detail, 'PATCH': order_obsolete}),
+    (re.compile(r'^/order$'), {'GET': order_list}),
+    (re.compile(r'^/serial_number$'), {'GET': serial_lookup, 'POST': serial_link}),
+]
+
+
+async def read_body(scope, receive):
+    chunks = list()
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    raw = b''.join(chunks)
+
+    if not raw:
+        return {}
+    content_type = dict(scope['headers']).get(b'content-type', b'')
+    if content_type.startswith(b'application/json'):
+        return json.loads(raw)
+    body = dict(parse_qsl(raw.decode()))
+    for key in ('order_id', 'menu_id'):
+        if key in body:
+            body[key] = int(body[key]) if body[key].isdigit() else None
+    return body
+
+
+async def send_json(send, payload, status):
+    body = json.dumps(payload).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await database.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    path = scope['path'].rstrip('/') or '/'
+    if path == '/events' and scope['method'] == 'GET':
+        try:
+            return await event_stream(scope, receive, send, dict(parse_qsl(scope.get('query_string', b'').decode())))
+        except HTTPError as e:
+            return await send_json(send, {'msg': e.message}, e.status)
+
+    for pattern, handlers in routes:
+        match = pattern.match(path)
+        if match:
+            break
+    else:
+        return await send_json(send, {'message': 'not found'}, 404)
+
+    handler = handlers.get(scope['method'])
+    if handler is None:
+        return await send_json(send, {'message': 'The method is not allowed for the requested URL.'}, 405)
+
+    try:
+        params = dict(parse_qsl(scope.get('query_string', b'').decode()))
+        body = await read_body(scope, receive)
+        kwargs = {key: int(value) for key, value in match.groupdict().items()}
+        payload, status = await handler(scope, params, body, **kwargs)
+    except HTTPError as e:
+        payload, status = {'msg': e.message}, e.status
+    except ValueError:
+        payload, status = {'message': 'malformed request body'}, 400
+    except Exception:
+        logger.exception('async request failed')
+        payload, status = {'message': 'Something went wrong'}, 500
+
+    await send_json(send, payload, status)
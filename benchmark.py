@@ -0,0 +1,83 @@
+"""Measures throughput, latency and worker memory of a running gunicorn pool.
+
+    python benchmark.py http://127.0.0.1:8000/serial_number?serial_number=abc \
+        --token <access token> --concurrency 32 --duration 30 --master-pid <gunicorn pid>
+"""
+import argparse
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+def worker_rss(master_pid):
+    """Resident and proportional set size (KiB) of every child of the gunicorn master."""
+    result = dict()
+    with open('/proc/{}/task/{}/children'.format(master_pid, master_pid)) as f:
+        children = [int(pid) for pid in f.read().split()]
+
+    for pid in children:
+        rss = pss = 0
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Rss:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('Pss:'):
+                    pss = int(line.split()[1])
+        result[pid] = (rss, pss)
+    return result
+
+
+def run(url, token, concurrency, duration):
+    latencies = list()
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    headers = {'Authorization': 'Bearer {}'.format(token)} if token else {}
+
+    def loop():
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                urllib.request.urlopen(urllib.request.Request(url, headers=headers)).read()
+                elapsed = time.monotonic() - started
+                with lock:
+                    latencies.append(elapsed)
+            except (urllib.error.URLError, ConnectionError):
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=loop) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url')
+    parser.add_argument('--token')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=int, default=30)
+    parser.add_argument('--master-pid', type=int)
+    args = parser.parse_args()
+
+    latencies, errors = run(args.url, args.token, args.concurrency, args.duration)
+    if latencies:
+        print('requests/s: {:.1f}'.format(len(latencies) / args.duration))
+        print('p50: {:.1f} ms  p99: {:.1f} ms'.format(latencies[len(latencies) // 2] * 1000,
+                                                      latencies[int(len(latencies) * 0.99)] * 1000))
+    print('errors: {}'.format(errors))
+
+    if args.master_pid and os.path.exists('/proc/{}'.format(args.master_pid)):
+        for pid, (rss, pss) in sorted(worker_rss(args.master_pid).items()):
+            print('worker {}: rss {} KiB, pss {} KiB'.format(pid, rss, pss))
+
+
+if __name__ == '__main__':
+    main()
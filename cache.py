@@ -0,0 +1,368 @@
+import collections
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+
+class TTLCache:
+    """Small bounded cache whose entries expire `ttl` seconds after they were set."""
+
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteStore:
+    """Cache store in a local SQLite file, shared by every worker on the host."""
+
+    versioned = False
+
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+
+    @classmethod
+    def from_config(cls, config, prefix):
+        return cls(config[prefix + '_SHARED_PATH'], maxsize=config.get(prefix + '_SHARED_SIZE', 100000))
+
+    def _connection(self):
+        # sqlite connections must not cross threads or forks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, version=None):
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', (key, value))
+        conn.execute('DELETE FROM cache WHERE rowid <= (SELECT max(rowid) FROM cache) - ?', (self.maxsize,))
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+
+class MmapStore:
+    """Cache store in a memory-mapped file (best under /dev/shm), shared by every worker on the host.
+
+    The file is a direct-mapped table: a key lives in slot hash(key) % slots, and writing a
+    key evicts whatever held its slot. Readers copy values straight out of the mapping without
+    a lock or a system call; a per-slot sequence number, odd while a write is in progress,
+    lets them detect torn reads. Writers serialize on a flock of the file.
+
+    Every key has a version, bumped by `delete`, and the file has a generation, bumped by
+    `clear`; both are visible to all workers at once, so a local copy tagged with the
+    `version()` it was read at is valid exactly as long as that version is unchanged.
+    Values that do not fit in a slot are not stored.
+    """
+
+    versioned = True
+
+    MAGIC = b'MMCACHE1'
+    VERSION_SLOTS = 65536
+    _header = struct.Struct('<8sQII')  # magic, generation, slots, slot size
+    _slot_header = struct.Struct('<IQHI')  # sequence, generation, key length, value length
+    _seq = struct.Struct('<I')
+    _counter = struct.Struct('<Q')
+    _generation_offset = 8
+    _versions_offset = mmap.PAGESIZE
+    _slots_offset = mmap.PAGESIZE + VERSION_SLOTS * _counter.size
+
+    def __init__(self, path, slots=8192, slot_size=4096):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.oversize = self.skipped_sets = 0
+        self._thread_lock = threading.Lock()
+        self._lock_fd = None
+        self._lock_pid = None
+
+        size = self._slots_offset + slots * slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, size)  # sparse; pages are only allocated once written
+                os.pwrite(fd, self._header.pack(self.MAGIC, 0, slots, slot_size), 0)
+            magic, _, file_slots, file_slot_size = self._header.unpack(os.pread(fd, self._header.size, 0))
+            if magic != self.MAGIC or (file_slots, file_slot_size) != (slots, slot_size):
+                raise ValueError('{} holds a cache with a different layout; remove it to change '
+                                 'the number or size of slots'.format(path))
+            self._map = mmap.mmap(fd, size)
+        finally:
+            # mmap keeps a duplicate of fd, which would go on holding the lock
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @classmethod
+    def from_config(cls, config, prefix):
+        return cls(config[prefix + '_SHARED_PATH'], slots=config.get(prefix + '_SLOTS', 8192),
+                   slot_size=config.get(prefix + '_SLOT_SIZE', 4096))
+
+    def _write_lock(self):
+        # flock is held per open file, and a forked worker must not share its parent's
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.path, os.O_RDWR)
+            self._lock_pid = os.getpid()
+        return _FileLock(self._thread_lock, self._lock_fd)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+    def _generation(self):
+        return self._counter.unpack_from(self._map, self._generation_offset)[0]
+
+    def _version_offset(self, key_hash):
+        return self._versions_offset + (key_hash % self.VERSION_SLOTS) * self._counter.size
+
+    def _slot_offset(self, key_hash):
+        return self._slots_offset + (key_hash % self.slots) * self.slot_size
+
+    def version(self, key):
+        key_hash = self._hash(key)
+        return self._generation(), self._counter.unpack_from(self._map, self._version_offset(key_hash))[0]
+
+    def get(self, key):
+        key_bytes = key.encode()
+        offset = self._slot_offset(self._hash(key))
+        start = offset + self._slot_header.size
+        for _ in range(3):
+            seq, generation, key_length, value_length = self._slot_header.unpack_from(self._map, offset)
+            if seq & 1 or self._slot_header.size + key_length + value_length > self.slot_size:
+                continue  # a write is in progress
+            if generation != self._generation() or self._map[start:start + key_length] != key_bytes:
+                return None
+            value = self._map[start + key_length:start + key_length + value_length]
+            if self._seq.unpack_from(self._map, offset)[0] == seq:
+                return value.decode()
+        return None
+
+    def _write_slot(self, offset, generation, key_bytes, value_bytes):
+        seq = self._seq.unpack_from(self._map, offset)[0]
+        self._seq.pack_into(self._map, offset, (seq + 1) & 0xffffffff)
+        start = offset + self._slot_header.size
+        self._map[start:start + len(key_bytes) + len(value_bytes)] = key_bytes + value_bytes
+        self._slot_header.pack_into(self._map, offset, (seq + 1) & 0xffffffff, generation,
+                                    len(key_bytes), len(value_bytes))
+        self._seq.pack_into(self._map, offset, (seq + 2) & 0xffffffff)
+
+    def set(self, key, value, version=None):
+        """Stores value unless the key was invalidated since `version` was read."""
+        key_bytes, value_bytes = key.encode(), value.encode()
+        if self._slot_header.size + len(key_bytes) + len(value_bytes) > self.slot_size:
+            self.oversize += 1
+            return
+        with self._write_lock():
+            if version is not None and self.version(key) != version:
+                self.skipped_sets += 1
+                return
+            self._write_slot(self._slot_offset(self._hash(key)), self._generation(), key_bytes, value_bytes)
+
+    def delete(self, key):
+        key_hash = self._hash(key)
+        offset = self._slot_offset(key_hash)
+        key_bytes = key.encode()
+        with self._write_lock():
+            # empty the slot before bumping the version: a reader that still got the old value
+            # has tagged it with the old version
+            _, _, key_length, _ = self._slot_header.unpack_from(self._map, offset)
+            start = offset + self._slot_header.size
+            if self._map[start:start + key_length] == key_bytes:
+                self._write_slot(offset, self._generation(), b'', b'')
+            version_offset = self._version_offset(key_hash)
+            self._counter.pack_into(self._map, version_offset,
+                                    self._counter.unpack_from(self._map, version_offset)[0] + 1)
+
+    def clear(self):
+        """Invalidates every key for every worker at once."""
+        with self._write_lock():
+            self._counter.pack_into(self._map, self._generation_offset, self._generation() + 1)
+
+    def stats(self):
+        return {'slots': self.slots, 'slot_size': self.slot_size, 'generation': self._generation(),
+                'oversize': self.oversize, 'skipped_sets': self.skipped_sets}
+
+
+class _FileLock:
+    def __init__(self, thread_lock, fd):
+        self.thread_lock = thread_lock
+        self.fd = fd
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+class LRUCache:
+    """Size-bounded LRU of JSON-serializable values with hit and memory statistics.
+
+    With a `shared` store, values are also written there so other workers can reuse them.
+    Local copies of a versioned store's values are checked against the key's version on
+    every read, so invalidations reach every worker immediately; with an unversioned store
+    they are trusted for `local_ttl` seconds, and without a store for `ttl` seconds (or
+    until evicted), which bounds how long another worker's invalidation can go unnoticed.
+    """
+
+    def __init__(self, maxsize=1024, shared=None, local_ttl=1.0, ttl=None):
+        self.maxsize = maxsize
+        self.shared = shared
+        self.versioned = getattr(shared, 'versioned', False)
+        self.local_ttl = local_ttl if shared is not None else ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # versions seen by each thread's last misses, so a set can tell if the key changed meanwhile
+        self._missed = threading.local()
+        self.hits = self.shared_hits = self.misses = self.evictions = 0
+        self.bytes = 0
+
+    def _set_local(self, key, value, size, version=None):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (time.monotonic(), value, size, version)
+            self.bytes += size
+            while len(self._entries) > self.maxsize:
+                self.bytes -= self._entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def _fresh(self, entry, version):
+        if self.versioned:
+            return entry[3] == version
+        return self.local_ttl is None or time.monotonic() - entry[0] < self.local_ttl
+
+    def get(self, key):
+        version = self.shared.version(str(key)) if self.versioned else None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._fresh(entry, version):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        if self.shared is not None:
+            serialized = self.shared.get(str(key))
+            if serialized is not None:
+                value = json.loads(serialized)
+                self._set_local(key, value, len(serialized), version)
+                self.shared_hits += 1
+                return value
+
+        self.misses += 1
+        if self.versioned:
+            missed = getattr(self._missed, 'versions', None)
+            if missed is None or len(missed) > 64:
+                missed = self._missed.versions = dict()
+            missed[key] = version
+        return None
+
+    def set(self, key, value):
+        serialized = json.dumps(value)
+        if not self.versioned:
+            self._set_local(key, value, len(serialized))
+            if self.shared is not None:
+                self.shared.set(str(key), serialized)
+            return
+
+        version = getattr(self._missed, 'versions', {}).pop(key, None)
+        self.shared.set(str(key), serialized, version=version)
+        current = self.shared.version(str(key))
+        if version is None or current == version:
+            self._set_local(key, value, len(serialized), current)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+        if self.shared is not None:
+            self.shared.delete(str(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        stats = {'size': len(self._entries), 'maxsize': self.maxsize,
+                 'hits': self.hits, 'shared_hits': self.shared_hits, 'misses': self.misses,
+                 'hit_ratio': round((self.hits + self.shared_hits) / lookups, 4) if lookups else None,
+                 'evictions': self.evictions, 'bytes': self.bytes,
+                 'backend': type(self.shared).__name__ if self.shared is not None else 'local'}
+        if hasattr(self.shared, 'stats'):
+            stats['shared'] = self.shared.stats()
+        return stats
+
+
+BACKENDS = {'sqlite': SqliteStore, 'mmap': MmapStore}
+
+
+def make_cache(config, prefix, maxsize=1024, ttl=None):
+    """LRUCache set up from the <prefix>_* config keys.
+
+    <prefix>_BACKEND picks the shared store from BACKENDS ('local' for none; 'sqlite' when
+    only <prefix>_SHARED_PATH is set), <prefix>_SIZE and <prefix>_TTL override the defaults.
+    Register another store in BACKENDS to plug it under every cache.
+    """
+    backend = config.get(prefix + '_BACKEND') or ('sqlite' if config.get(prefix + '_SHARED_PATH') else 'local')
+    if backend == 'local':
+        shared = None
+    elif backend in BACKENDS:
+        shared = BACKENDS[backend].from_config(config, prefix)
+    else:
+        raise ValueError('unknown cache backend {!r} for {}'.format(backend, prefix))
+    return LRUCache(maxsize=config.get(prefix + '_SIZE', maxsize), shared=shared,
+                    ttl=config.get(prefix + '_TTL', ttl))
@@ -0,0 +1,176 @@
+import datetime
+import time
+import click
+import sqlalchemy
+from run import app, db
+from models import MenuChangeModel, SerialNumberModel, SerialNumberArchiveModel, IdempotencyKeyModel
+from resources import serial_cache
+from sharding import router, shard_tables, SLOTS
+
+
+@app.cli.command('compact-menu-changes')
+@click.option('--batch-size', default=1000, help='Rows deleted per transaction.')
+@click.option('--pause', default=0.05, help='Seconds to sleep between batches.')
+def compact_menu_changes(batch_size, pause):
+    """Keeps only the latest change per menu, bounding menu_change by the number of menus."""
+    deleted = 0
+    while True:
+        versions = MenuChangeModel.find_superseded(limit=batch_size)
+        if not versions:
+            break
+        deleted += MenuChangeModel.delete_versions(versions)
+        db.session.commit()
+        time.sleep(pause)
+
+    click.echo('{} superseded menu change(s) deleted'.format(deleted))
+
+
+@app.cli.command('compact-serials')
+@click.option('--days', type=int, default=None, help='Retention in days; SERIAL_RETENTION_DAYS when omitted.')
+@click.option('--batch-size', default=200, help='Links removed per transaction.')
+@click.option('--pause', default=0.1, help='Seconds to sleep between batches.')
+@click.option('--archive/--delete', default=False, help='Copy removed links to serial_number_archive first.')
+@click.option('--from-shard', default=0, help='Order shard to start with, to resume an interrupted run.')
+@click.option('--after-id', default=0, help='Skip links of the first shard up to this id, to resume a run.')
+def compact_serials(days, batch_size, pause, archive, from_shard, after_id):
+    """Removes serial links of obsoleted orders that are older than the retention period.
+
+    Every batch is its own short transaction, so lookups are never blocked for long and the
+    command can be stopped at any time; progress lines give the shard and id to resume from.
+    """
+    if days is None:
+        days = app.config.get('SERIAL_RETENTION_DAYS', 180)
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+    sessions = router.sessions if router.enabled else [db.session]
+    if archive:
+        router.create_all(db.metadata)
+
+    processed = 0
+    start = time.monotonic()
+    for shard in range(from_shard, len(sessions)):
+        session = sessions[shard]
+        last_id = after_id if shard == from_shard else 0
+        while True:
+            links = SerialNumberModel.find_expired(session, cutoff, last_id, batch_size)
+            if not links:
+                break
+            last_id = links[-1].id
+            serial_numbers = [link.serial_number for link in links]
+
+            if archive:
+                SerialNumberArchiveModel.archive(session, links)
+            SerialNumberModel.delete_ids(session, [link.id for link in links])
+            session.commit()
+            if serial_cache.shared is not None:
+                # a local cache lives in each worker; theirs expire after SERIAL_CACHE_TTL instead
+                for serial_number in serial_numbers:
+                    serial_cache.delete(serial_number)
+
+            processed += len(links)
+            click.echo('{} link(s) removed, {:.1f} rows/s, resume with --from-shard {} --after-id {}'.format(
+                processed, processed / (time.monotonic() - start), shard, last_id), err=True)
+            time.sleep(pause)
+
+    elapsed = time.monotonic() - start
+    click.echo('{} serial link(s) {} in {:.1f}s ({:.1f} rows/s)'.format(
+        processed, 'archived' if archive else 'deleted', elapsed, processed / elapsed if elapsed else 0.0))
+
+
+@app.cli.command('compact-idempotency-keys')
+@click.option('--batch-size', default=1000, help='Rows deleted per transaction.')
+@click.option('--pause', default=0.05, help='Seconds to sleep between batches.')
+def compact_idempotency_keys(batch_size, pause):
+    """Deletes Idempotency-Key records whose IDEMPOTENCY_KEY_TTL has passed."""
+    deleted = 0
+    while True:
+        count = IdempotencyKeyModel.delete_expired(limit=batch_size)
+        if not count:
+            break
+        deleted += count
+        db.session.commit()
+        time.sleep(pause)
+
+    click.echo('{} expired idempotency key(s) deleted'.format(deleted))
+
+
+@app.cli.command('create-shard-tables')
+def create_shard_tables():
+    """Creates the order, line item and serial tables missing on the ORDER_SHARDS databases."""
+    if not router.enabled:
+        raise click.UsageError('ORDER_SHARDS is not configured')
+
+    router.create_all(db.metadata)
+    click.echo('sharded tables created on {} shard(s)'.format(len(router.engines)))
+
+
+@app.cli.command('reshard-orders')
+@click.option('--source', default=None,
+              help='Comma separated URIs of the previous shard layout; the main database when omitted.')
+@click.option('--batch-size', default=500, help='Orders read from a source per query.')
+@click.option('--id-map', type=click.File('w'), default='-', help='File receiving "old id,new id" lines.')
+@click.option('--delete-source/--keep-source', default=False, help='Delete moved orders from their source.')
+def reshard_orders(source, batch_size, id_map, delete_source):
+    """Moves orders, their line items and serial links into the ORDER_SHARDS layout.
+
+    Orders that already sit on their target shard are left alone; moved orders get new ids,
+    which are written to --id-map. Run it while order writes are stopped.
+    """
+    if not router.enabled:
+        raise click.UsageError('ORDER_SHARDS is not configured')
+
+    metadata = shard_tables(db.metadata)
+    for engine in router.engines:
+        metadata.create_all(engine)
+    order, association, serial = (metadata.tables[name] for name in ('order', 'association_model', 'serial_number'))
+
+    if source:
+        source_uris = source.split(',')
+        sources = [(index, sqlalchemy.create_engine(uri)) for index, uri in enumerate(source_uris)]
+    else:
+        source_uris = list()
+        sources = [(None, db.engine)]
+
+    moved = 0
+    for source_index, source_engine in sources:
+        last_id = 0
+        while True:
+            with source_engine.connect() as conn:
+                orders = conn.execute(order.select().where(order.c.id > last_id)
+                                      .order_by(order.c.id).limit(batch_size)).fetchall()
+            if not orders:
+                break
+            last_id = orders[-1].id
+
+            for row in orders:
+                target = router.shard_for_user(row.user_id)
+                if source_index is None:
+                    old_id = row.id
+                else:
+                    old_id = row.id * SLOTS + source_index
+                    if source_index == target and source_uris[source_index] == router.uris[target]:
+                        continue
+
+                with source_engine.connect() as conn:
+                    items = conn.execute(association.select().where(association.c.order_id == row.id)).fetchall()
+                    links = conn.execute(serial.select().where(serial.c.order_id == row.id)).fetchall()
+
+                with router.engines[target].begin() as conn:
+                    values = {key: value for key, value in row.items() if key != 'id'}
+                    local_id = conn.execute(order.insert().values(**values)).inserted_primary_key[0]
+                    if items:
+                        conn.execute(association.insert(), [dict(item.items(), order_id=local_id) for item in items])
+                    if links:
+                        conn.execute(serial.insert(), [dict({key: value for key, value in link.items() if key != 'id'},
+                                                            order_id=local_id) for link in links])
+
+                if delete_source:
+                    with source_engine.begin() as conn:
+                        conn.execute(serial.delete().where(serial.c.order_id == row.id))
+                        conn.execute(association.delete().where(association.c.order_id == row.id))
+                        conn.execute(order.delete().where(order.c.id == row.id))
+
+                id_map.write('{},{}\n'.format(old_id, local_id * SLOTS + target))
+                moved += 1
+
+    click.echo('{} order(s) moved'.format(moved), err=True)
@@ -0,0 +1,201 @@
+"""Push channel for order and serial number changes.
+
+Handlers call `publish` after their commit. The broker carries the event to every worker
+(LocalBroker within one process, RedisBroker across processes), and each worker's hub fans
+it out to the streams subscribed in that process.
+
+A stream holds its connection open for minutes, so serve /events from the ASGI app
+(asgi.py), where a subscriber costs a coroutine instead of a worker thread.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+TOPICS = ('order', 'serial_number')
+
+
+class Subscription:
+    def __init__(self, user_id, topics, maxsize):
+        self.user_id = user_id
+        self.topics = set(topics)
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def accepts(self, event):
+        return event['user_id'] == self.user_id and event['type'].split('.')[0] in self.topics
+
+    def deliver(self, event):
+        """False when the subscriber is too far behind and the event was dropped."""
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    """Subscription consumed by a coroutine; events may be dispatched from any thread."""
+
+    def __init__(self, user_id, topics, maxsize, loop):
+        super().__init__(user_id, topics, maxsize)
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.loop = loop
+
+    def deliver(self, event):
+        # full() read from another thread is a hint; _put drops what does not fit after all
+        if self.queue.full():
+            return False
+        self.loop.call_soon_threadsafe(self._put, event)
+        return True
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventHub:
+    """In-process fan-out from one published event to all matching subscriptions."""
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def subscribe(self, user_id, topics, loop=None):
+        if loop is None:
+            subscription = Subscription(user_id, topics, self.maxsize)
+        else:
+            subscription = AsyncSubscription(user_id, topics, self.maxsize, loop)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def dispatch(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            if subscription.accepts(event) and not subscription.deliver(event):
+                self.dropped += 1
+
+
+class LocalBroker:
+    """Single-process stand-in: published events go straight to the local hub."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, event):
+        self.hub.dispatch(event)
+
+
+class RedisBroker:
+    """Cross-worker broker over Redis pub/sub; every worker listens on one channel."""
+
+    def __init__(self, hub, url, channel='coffee_cloud.events'):
+        import redis
+
+        self.hub = hub
+        self.url = url
+        self.channel = channel
+        self.client = redis.Redis.from_url(url)
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        # threads do not survive a fork, so every worker starts its own listener lazily
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._listen, name='event-listener', daemon=True)
+            thread.start()
+            self._listener_pid = os.getpid()
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            try:
+                self.hub.dispatch(json.loads(message['data']))
+            except (Exception,):
+                logger.exception('event dispatch failed')
+
+    def publish(self, event):
+        self._ensure_listener()
+        self.client.publish(self.channel, json.dumps(event))
+
+    def subscribe(self):
+        self._ensure_listener()
+
+
+hub = EventHub()
+broker = LocalBroker(hub)
+
+
+def init_app(app):
+    global broker
+
+    hub.maxsize = app.config.get('EVENT_QUEUE_SIZE', 100)
+    url = app.config.get('EVENT_BROKER_URL')
+    broker = RedisBroker(hub, url) if url else LocalBroker(hub)
+
+
+def publish(event_type, user_id, **data):
+    event = dict(data, type=event_type, user_id=user_id)
+    try:
+        broker.publish(event)
+    except (Exception,):
+        logger.exception('publish event %s failed', event_type)
+
+
+def subscribe(user_id, topics, loop=None):
+    """Pass the running event loop to consume the subscription from a coroutine."""
+    if hasattr(broker, 'subscribe'):
+        broker.subscribe()
+    return hub.subscribe(user_id, topics, loop)
+
+
+def format_event(event):
+    return 'event: {}\ndata: {}\n\n'.format(event['type'], json.dumps(event))
+
+
+def stream(subscription, heartbeat=15, max_duration=300):
+    """Yields server-sent events until max_duration, after which the client reconnects."""
+    deadline = time.monotonic() + max_duration
+    try:
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            event = subscription.get(timeout=heartbeat)
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield format_event(event)
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,67 @@
+"""Gunicorn serving profiles, picked with GUNICORN_PROFILE:
+
+    io     threaded workers for the DB-bound order, serial and menu routes (default)
+    cpu    sync workers for the pbkdf2 routes: /login, /user/registration, /user/reset_password
+    async  uvicorn workers running the ASGI app in asgi.py, for the /events streams
+
+Run one pool per profile behind the proxy and route by path, e.g.
+    GUNICORN_PROFILE=cpu gunicorn -b 127.0.0.1:8001
+    GUNICORN_PROFILE=io gunicorn -b 127.0.0.1:8002
+
+The app is preloaded in the master so workers share its imported code copy-on-write;
+each worker then drops the inherited DB pool, restarts the log listener thread and warms
+its caches (see warmup.py) before it accepts requests.
+GUNICORN_WORKERS and GUNICORN_THREADS override the per-profile defaults.
+"""
+import multiprocessing
+import os
+
+
+cores = multiprocessing.cpu_count()
+
+PROFILES = {
+    'io': {'wsgi_app': 'run:app', 'worker_class': 'gthread', 'workers': cores + 1, 'threads': 8},
+    'cpu': {'wsgi_app': 'run:app', 'worker_class': 'sync', 'workers': cores, 'threads': 1},
+    'async': {'wsgi_app': 'asgi:application', 'worker_class': 'uvicorn.workers.UvicornWorker',
+              'workers': cores, 'threads': 1},
+}
+
+profile = PROFILES[os.environ.get('GUNICORN_PROFILE', 'io')]
+
+wsgi_app = profile['wsgi_app']
+worker_class = profile['worker_class']
+workers = int(os.environ.get('GUNICORN_WORKERS', profile['workers']))
+threads = int(os.environ.get('GUNICORN_THREADS', profile['threads']))
+# read by run.py before the preloaded app sizes its load shedding budget
+os.environ['WORKER_THREADS'] = str(threads)
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+preload_app = True
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# recycle workers now and then to cap slow leaks; jitter keeps them from restarting together
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def post_fork(server, worker):
+    from run import db
+    from sharding import router
+    import log_config
+
+    # pooled connections opened in the master must not be shared with the children
+    db.engine.dispose()
+    router.dispose()
+    log_config.after_fork()
+
+
+def post_worker_init(worker):
+    # the ASGI app does not use the Flask caches
+    if wsgi_app != 'run:app':
+        return
+
+    from run import app
+    import warmup
+
+    warmup.run(app)
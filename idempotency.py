@@ -0,0 +1,199 @@
+"""Idempotency-Key support for non-idempotent POST handlers.
+
+The first request with a key claims a row in `idempotency_key` and stores its response
+there; retries with the same key replay that response without running the handler again.
+Recent responses are also kept in a bounded in-process cache, and concurrent duplicates in
+one process wait until the first one's transaction has ended and then replay its response. A claim that got no response within
+IDEMPOTENCY_IN_FLIGHT_TIMEOUT (its worker died) is taken over by the next retry, and
+`flask compact-idempotency-keys` deletes expired keys.
+"""
+import collections
+import datetime
+import json
+import threading
+from functools import wraps
+from flask import current_app, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy.exc import IntegrityError
+import unit_of_work
+from run import db
+from models import UserModel, IdempotencyKeyModel
+
+
+HEADER = 'Idempotency-Key'
+
+
+class ReplayCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= datetime.datetime.utcnow():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, expire_date, response):
+        with self._lock:
+            self._entries[key] = (expire_date, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class KeyLocks:
+    """One lock per key that is currently in flight, dropped once nobody holds it.
+
+    The holder keeps it until its request is committed or rolled back, see `_release_lock`.
+    """
+
+    def __init__(self):
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        with self._lock:
+            lock, holders = self._locks.get(key, (threading.Lock(), 0))
+            self._locks[key] = (lock, holders + 1)
+        lock.acquire()
+
+    def release(self, key):
+        with self._lock:
+            lock, holders = self._locks[key]
+            if holders == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, holders - 1)
+        lock.release()
+
+
+replay_cache = ReplayCache()
+key_locks = KeyLocks()
+
+
+def _split(result):
+    if isinstance(result, tuple):
+        return result[0], result[1]
+    return result, 200
+
+
+def _replay(response):
+    if len(response) == 3:
+        return response
+    body, status = response
+    return body, status, {'Idempotent-Replayed': 'true'}
+
+
+def _in_progress():
+    return {'message': 'a request with this {} is still in progress'.format(HEADER)}, 409, {'Retry-After': '1'}
+
+
+def _stored_response(cache_key):
+    response = replay_cache.get(cache_key)
+    if response is not None:
+        return response
+
+    record = IdempotencyKeyModel.find_by_user_and_key(user_id=cache_key[0], key=cache_key[1])
+    if record is None:
+        return None
+    if record.expire_date <= datetime.datetime.utcnow():
+        record.delete_from_db()
+        db.session.commit()
+        return None
+    if record.status_code is None:
+        timeout = current_app.config.get('IDEMPOTENCY_IN_FLIGHT_TIMEOUT', datetime.timedelta(seconds=60))
+        if IdempotencyKeyModel.delete_abandoned(record.id, datetime.datetime.utcnow() - timeout):
+            db.session.commit()
+            return None
+        return _in_progress()
+
+    response = (json.loads(record.response), record.status_code)
+    replay_cache.set(cache_key, record.expire_date, response)
+    return response
+
+
+def _release(record_id):
+    IdempotencyKeyModel.query.filter_by(id=record_id).delete()
+    db.session.commit()
+
+
+def _release_lock(cache_key):
+    """Releases the key lock once the request transaction has ended, so a waiting duplicate
+    finds the committed response (or the released claim) rather than an in-flight one."""
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            key_locks.release(cache_key)
+
+    # registered last, so the response is cached or the claim deleted by the time it runs
+    unit_of_work.after_commit(release)
+    unit_of_work.on_failure(release)
+
+
+def idempotent(should_store=lambda body, status: status < 400):
+    """Replays the stored response for a repeated Idempotency-Key header.
+
+    Must be applied inside @jwt_required, as keys are scoped to the logged-in user.
+    Responses rejected by `should_store` release the key so the client can retry.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return func(*args, **kwargs)
+            if len(key) > 255:
+                return {'message': '{} is too long.'.format(HEADER)}, 400
+
+            logged_user = UserModel.find_by_username(get_jwt_identity())
+            cache_key = (logged_user.id, key)
+
+            key_locks.acquire(cache_key)
+            try:
+                response = _stored_response(cache_key)
+                if response is not None:
+                    return _replay(response)
+
+                ttl = current_app.config.get('IDEMPOTENCY_KEY_TTL', datetime.timedelta(hours=24))
+                record = IdempotencyKeyModel(user_id=logged_user.id, key=key,
+                                             expire_date=datetime.datetime.utcnow() + ttl)
+                try:
+                    # the claim is committed on its own so other workers see it while the handler runs
+                    record.save_to_db()
+                    db.session.commit()
+                except IntegrityError:
+                    # another worker claimed the key between our lookup and insert
+                    db.session.rollback()
+                    response = _stored_response(cache_key)
+                    return _replay(response) if response else _in_progress()
+
+                record_id, expire_date = record.id, record.expire_date
+                unit_of_work.on_failure(lambda: _release(record_id))
+
+                result = func(*args, **kwargs)
+                body, status = _split(result)
+                if should_store(body, status):
+                    # stored in the same transaction as the handler's own writes
+                    record.status_code = status
+                    record.response = json.dumps(body)
+                    record.save_to_db()
+                    unit_of_work.after_commit(lambda: replay_cache.set(cache_key, expire_date, (body, status)))
+                else:
+                    record.delete_from_db()
+                return result
+            finally:
+                _release_lock(cache_key)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,168 @@
+"""Concurrency limits that shed load instead of queueing it.
+
+All limited requests of a process draw from one budget: the worker's WORKER_THREADS. Each
+priority class may only take a slot while the process has fewer requests in flight than the
+class's share of those threads, so the lower classes together can never occupy every thread
+and `critical` always finds one free:
+
+    critical   every thread      /serial_number, /order/<id>, /order/batch
+    normal     3/4 of them       the other API routes
+    bulk       1/2 of them       password hashing and order list scans
+    stream     1/4 of them       /events streams served by the WSGI app
+
+A request that finds its class full waits at most the class's queue_timeout (zero for bulk
+and streams, as a waiting request holds a thread too) and is then answered 503 with
+Retry-After. Admitted, shed and in-flight counts are kept per resource for /metrics.
+"""
+import threading
+import time
+from functools import wraps
+from flask import current_app
+
+
+DEFAULT_PRIORITIES = {
+    'critical': {'share': 1.0, 'queue_timeout': 0.25, 'retry_after': 1},
+    'normal': {'share': 0.75, 'queue_timeout': 0.05, 'retry_after': 2},
+    'bulk': {'share': 0.5, 'queue_timeout': 0.0, 'retry_after': 5},
+    'stream': {'share': 0.25, 'queue_timeout': 0.0, 'retry_after': 10},
+}
+
+
+class PriorityClass:
+    def __init__(self, name, threads, share, queue_timeout, retry_after):
+        self.name = name
+        # below a full share, leave at least one thread to the classes above
+        ceiling = threads if share >= 1 else min(int(threads * share), threads - 1)
+        self.ceiling = max(1, ceiling)
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+
+    def stats(self):
+        return {'ceiling': self.ceiling, 'queue_timeout': self.queue_timeout, 'in_flight': self.in_flight}
+
+
+class Budget:
+    """The worker threads of this process, shared by every priority class."""
+
+    def __init__(self, threads, priorities):
+        self.threads = threads
+        self.classes = {name: PriorityClass(name, threads, **settings) for name, settings in priorities.items()}
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, priority):
+        priority_class = self.classes[priority]
+        deadline = time.monotonic() + priority_class.queue_timeout
+        with self._condition:
+            while self.in_flight >= priority_class.ceiling:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            priority_class.in_flight += 1
+        return True
+
+    def release(self, priority):
+        with self._condition:
+            self.in_flight -= 1
+            self.classes[priority].in_flight -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        return {'threads': self.threads, 'in_flight': self.in_flight,
+                'classes': {name: priority_class.stats() for name, priority_class in self.classes.items()}}
+
+
+class Limiter:
+    """Counters of one resource; the slots themselves belong to the budget."""
+
+    def __init__(self, budget, name, priority):
+        self.budget = budget
+        self.name = name
+        self.priority = priority
+        self.retry_after = budget.classes[priority].retry_after
+        self._lock = threading.Lock()
+        self.in_flight = self.admitted = self.shed = 0
+
+    def acquire(self):
+        if not self.budget.acquire(self.priority):
+            with self._lock:
+                self.shed += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+            self.admitted += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self.budget.release(self.priority)
+
+    def stats(self):
+        return {'priority': self.priority, 'in_flight': self.in_flight, 'admitted': self.admitted, 'shed': self.shed}
+
+
+_budget = None
+_limiters = dict()
+_limiters_lock = threading.Lock()
+
+
+def _make_budget():
+    overrides = current_app.config.get('LOAD_SHEDDING', {})
+    priorities = {name: dict(settings, **overrides.get(name, {})) for name, settings in DEFAULT_PRIORITIES.items()}
+    return Budget(current_app.config.get('WORKER_THREADS', 8), priorities)
+
+
+def limiter(name, priority='normal'):
+    """Counters and slots of the named resource, for limits that outlive a handler call."""
+    global _budget
+
+    resource = _limiters.get(name)
+    if resource is None:
+        with _limiters_lock:
+            resource = _limiters.get(name)
+            if resource is None:
+                if _budget is None:
+                    _budget = _make_budget()
+                resource = _limiters[name] = Limiter(_budget, name, priority)
+    return resource
+
+
+def busy(resource):
+    return {'message': 'server is busy, please retry later'}, 503, {'Retry-After': str(resource.retry_after)}
+
+
+def limit(name, priority='normal'):
+    """Resource method decorator, meant for `method_decorators`."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            resource = limiter(name, priority)
+            if not resource.acquire():
+                return busy(resource)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                resource.release()
+
+        return wrapper
+
+    return decorator
+
+
+def reset():
+    """Forgets the budget and counters, e.g. after WORKER_THREADS or LOAD_SHEDDING changed."""
+    global _budget
+
+    with _limiters_lock:
+        _budget = None
+        _limiters.clear()
+
+
+def stats():
+    return {'budget': _budget.stats() if _budget is not None else None,
+            'resources': {name: resource.stats() for name, resource in _limiters.items()}}
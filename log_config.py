@@ -0,0 +1,119 @@
+import atexit
+import itertools
+import json
+import logging
+import queue
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from flask import g, has_request_context, request
+
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+_listener = None
+_queue_handler = None
+
+
+class RequestIdFilter(logging.Filter):
+    """Tags every record with the id of the request that emitted it."""
+
+    def filter(self, record):
+        record.request_id = g.get('request_id', '-') if has_request_context() else '-'
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in N records below WARNING for the configured loggers."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._counters = {name: itertools.count() for name in self.rates}
+
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        if not rate or record.levelno >= logging.WARNING:
+            return True
+        return next(self._counters[record.name]) % rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        payload.update({k: v for k, v in vars(record).items() if k not in _STANDARD_ATTRS})
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler that leaves formatting and I/O to the listener thread.
+
+    Only the message interpolation happens on the caller, so mutable args can not change
+    before the listener gets to the record.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def after_fork():
+    """Restarts the listener thread in a forked worker; threads do not survive fork()."""
+    global _listener
+
+    if _listener is None:
+        return
+    log_queue = queue.Queue(-1)
+    _queue_handler.queue = log_queue
+    _listener = QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def init_app(app):
+    global _listener, _queue_handler
+
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    if app.config.get('LOG_JSON', True):
+        stream_handler.setFormatter(JsonFormatter(datefmt='%m-%d %H:%M:%S'))
+    else:
+        stream_handler.setFormatter(logging.Formatter(datefmt='%m-%d %H:%M',
+                                                      fmt='%(asctime)s %(request_id)s %(name)-12s '
+                                                          '%(levelname)-8s %(message)s'))
+
+    log_queue = queue.Queue(-1)
+    _queue_handler = DeferredQueueHandler(log_queue)
+    _queue_handler.addFilter(RequestIdFilter())
+    _queue_handler.addFilter(SamplingFilter(app.config.get('LOG_SAMPLING', {})))
+
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(app.config.get('LOG_LEVEL', logging.INFO))
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop_listener)
+
+    @app.before_request
+    def assign_request_id():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
+    @app.after_request
+    def expose_request_id(response):
+        response.headers.setdefault('X-Request-ID', g.get('request_id', ''))
+        return response
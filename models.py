@@ -1,6 +1,10 @@
 import enum
 import datetime
-from run import db
+from sqlalchemy.orm import selectinload, joinedload, load_only, object_session
+from run import app, db
+from cache import TTLCache
+from unit_of_work import after_commit
+from sharding import router
 from passlib.hash import pbkdf2_sha256 as sha256
 
 
@@ -54,6 +58,10 @@ class TasteLevels(DBEnum):
     STRONG = 'strong'
 
 
+# other workers notice a bumped epoch once their cached copy expires
+token_epoch_cache = TTLCache(maxsize=10000, ttl=app.config.get('TOKEN_EPOCH_CACHE_TTL', 5))
+
+
 class UserModel(db.Model):
     __tablename__ = 'user'
 
@@ -64,20 +72,43 @@ class UserModel(db.Model):
     gender = db.Column(db.Enum(*Gender.get_enum_labels()), default=Gender.NONE.value)  # gender
     birthday = db.Column(db.Date, nullable=True)
     email = db.Column(db.String(255), nullable=False, default="")
+    token_epoch = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # bumped to revoke all tokens
     menu_list = db.relationship('MenuModel', back_populates='owner', lazy=True)
     order_list = db.relationship('OrderModel', back_populates='owner', lazy=True)
 
     def save_to_db(self):
         db.session.add(self)
-        db.session.commit()
+
+    def revoke_all_tokens(self):
+        self.token_epoch = UserModel.token_epoch + 1
+        self.save_to_db()
+        db.session.flush()
+        username = self.username
+        # until the commit only this session sees the new epoch, so it must not reach the cache;
+        # the mark goes away with the session at the end of the request
+        db.session.info.setdefault('revoking_tokens', set()).add(username)
+        token_epoch_cache.delete(username)
+        after_commit(lambda: token_epoch_cache.delete(username))
+
+    @classmethod
+    def get_token_epoch(cls, username, cached=True):
+        """Epoch for the blacklist check; cached=False reads the database, as issuing tokens must."""
+        epoch = token_epoch_cache.get(username) if cached else None
+        if epoch is None:
+            row = db.session.query(cls.token_epoch).filter_by(username=username).first()
+            epoch = row.token_epoch if row else 0
+            if cached and username not in db.session.info.get('revoking_tokens', ()):
+                token_epoch_cache.set(username, epoch)
+        return epoch
 
     @classmethod
     def find_by_username(cls, username):
         return cls.query.filter_by(username=username).first()
 
     @classmethod
-    def get_by_id(cls, user_id: int):
-        return cls.query.get(user_id)
+    def get_by_id(cls, user_id: int, columns=None):
+        query = cls.query.options(load_only(*columns)) if columns else cls.query
+        return query.get(user_id)
 
     @classmethod
     def return_all(cls):
@@ -93,7 +124,6 @@ class UserModel(db.Model):
     def delete_all(cls):
         try:
             num_rows_deleted = db.session.query(cls).delete()
-            db.session.commit()
             return {'message': '{} row(s) deleted'.format(num_rows_deleted)}
         except:
             return {'message': 'Something went wrong'}
@@ -114,7 +144,6 @@ class RevokedTokenModel(db.Model):
 
     def add(self):
         db.session.add(self)
-        db.session.commit()
 
     @classmethod
     def is_jti_blacklisted(cls, jti):
@@ -122,6 +151,15 @@ class RevokedTokenModel(db.Model):
         return bool(query)
 
 
+def is_token_revoked(decrypted_token):
+    """Blacklist check of both apps: tokens older than the user's epoch and revoked jtis."""
+    claims = decrypted_token.get(app.config.get('JWT_USER_CLAIMS', 'user_claims')) or {}
+    identity = decrypted_token[app.config.get('JWT_IDENTITY_CLAIM', 'identity')]
+    if claims.get('epoch', 0) < UserModel.get_token_epoch(identity):
+        return True
+    return RevokedTokenModel.is_jti_blacklisted(decrypted_token['jti'])
+
+
 class AssociationModel(db.Model):
     __tablename_ = 'association_menu_order'
     menu_id = db.Column(db.Integer, db.ForeignKey('menu.id'), primary_key=True)
@@ -133,6 +171,8 @@ class AssociationModel(db.Model):
 
 class MenuModel(db.Model):
     __tablename__ = 'menu'
+    __table_args__ = (db.Index('ix_menu_owner_id_name', 'owner_id', 'name'),
+                      db.Index('ix_menu_owner_id_menu_type_coffee_option', 'owner_id', 'menu_type', 'coffee_option'))
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255))
     menu_type = db.Column(db.Enum(*MenuTypes.get_enum_labels()), default=MenuTypes.CUSTOMIZED.value)  # menu type
@@ -149,11 +189,44 @@ class MenuModel(db.Model):
 
     def save_to_db(self):
         db.session.add(self)
-        db.session.commit()
 
     @classmethod
-    def find_by_user(cls, owner: UserModel):
-        return cls.query.filter_by(owner_id=owner.id)
+    def find_by_user(cls, owner: UserModel, columns=None):
+        query = cls.query.filter_by(owner_id=owner.id)
+        return query.options(load_only(*columns)) if columns else query
+
+    @classmethod
+    def _search_criteria(cls, owner: UserModel, filters: dict, prefix: str = None):
+        criteria = [cls.owner_id == owner.id]
+        criteria.extend(getattr(cls, facet).in_(values) for facet, values in filters.items() if values)
+        if prefix:
+            criteria.append(cls.name.startswith(prefix, autoescape=True))
+        return criteria
+
+    @classmethod
+    def search(cls, owner: UserModel, filters: dict, prefix: str = None):
+        return cls.query.filter(*cls._search_criteria(owner, filters, prefix)).order_by(cls.name, cls.id)
+
+    @classmethod
+    def facet_counts(cls, owner: UserModel, filters: dict, prefix: str = None):
+        """Counts per enum value of every facet, in one round trip of grouped selects.
+
+        Each facet is counted with every filter but its own, so the counts tell how many
+        menus selecting that value instead would return.
+        """
+        selects = list()
+        for facet in MENU_FACETS:
+            other_filters = {key: values for key, values in filters.items() if key != facet}
+            value = db.cast(getattr(cls, facet), db.String(32))
+            selects.append(db.session.query(db.literal(facet), value, db.func.count(cls.id))
+                           .filter(*cls._search_criteria(owner, other_filters, prefix))
+                           .group_by(value))
+
+        counts = {facet: dict.fromkeys(labels.get_enum_labels(), 0) for facet, labels in MENU_FACETS.items()}
+        for facet, value, count in selects[0].union_all(*selects[1:]):
+            if value in counts[facet]:
+                counts[facet][value] = count
+        return counts
 
     @classmethod
     def get_by_owner_and_id(cls, menu_id: int, owner: UserModel):
@@ -163,6 +236,63 @@ class MenuModel(db.Model):
     def get_by_id(cls, menu_id: int):
         return cls.query.get(menu_id)
 
+    @classmethod
+    def find_by_owner_and_ids(cls, owner: UserModel, menu_ids):
+        return cls.query.filter(cls.owner_id == owner.id, cls.id.in_(menu_ids))
+
+    @classmethod
+    def find_by_owner_ids(cls, owner_ids):
+        return cls.query.filter(cls.owner_id.in_(owner_ids)).order_by(cls.owner_id, cls.id)
+
+
+class MenuChangeModel(db.Model):
+    """Change log of menu writes; `version` orders the changes for delta sync."""
+    __tablename__ = 'menu_change'
+    __table_args__ = (db.Index('ix_menu_change_owner_id_version', 'owner_id', 'version'),)
+    version = db.Column(db.Integer, primary_key=True)
+    menu_id = db.Column(db.Integer, nullable=False, index=True)  # no foreign key, so tombstones outlive menus
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    create_date = db.Column(db.DATETIME, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def record(cls, menu: MenuModel):
+        db.session.flush()
+        db.session.add(cls(menu_id=menu.id, owner_id=menu.owner_id))
+
+    @classmethod
+    def find_since(cls, owner: UserModel, version: int):
+        return cls.query.filter(cls.owner_id == owner.id, cls.version > version).order_by(cls.version)
+
+    @classmethod
+    def settled_version(cls, owner: UserModel, version: int, cutoff: datetime.datetime):
+        """Newest version after `version` that precedes every change younger than cutoff."""
+        unsettled = db.session.query(db.func.min(cls.version)) \
+            .filter(cls.owner_id == owner.id, cls.version > version, cls.create_date > cutoff).as_scalar()
+        return db.session.query(db.func.max(cls.version)) \
+            .filter(cls.owner_id == owner.id, cls.version > version,
+                    db.or_(unsettled.is_(None), cls.version < unsettled)).scalar() or version
+
+    @classmethod
+    def find_superseded(cls, limit: int):
+        """Versions that have a newer change for the same menu, oldest first."""
+        latest = db.session.query(db.func.max(cls.version)).group_by(cls.menu_id)
+        return [row.version for row in db.session.query(cls.version).filter(~cls.version.in_(latest))
+                .order_by(cls.version).limit(limit)]
+
+    @classmethod
+    def delete_versions(cls, versions):
+        return cls.query.filter(cls.version.in_(versions)).delete(synchronize_session=False)
+
+
+MENU_FACETS = {
+    'menu_type': MenuTypes,
+    'coffee_option': CoffeeOption,
+    'taste_level': TasteLevels,
+    'water_level': WaterLevels,
+    'foam_level': FoamLevels,
+    'grind_size': SizeLevels,
+}
+
 
 class OrderModel(db.Model):
     __tablename__ = 'order'
@@ -175,21 +305,62 @@ class OrderModel(db.Model):
     menus = db.relationship('AssociationModel', back_populates='order')
     is_obsolete = db.Column(db.Boolean, default=False)
 
+    @property
+    def public_id(self):
+        """Id exposed to clients; encodes the shard when orders are sharded."""
+        return router.public_id(self)
+
     def save_to_db(self):
-        db.session.add(self)
-        db.session.commit()
+        if router.enabled:
+            router.session_for_user(self.user_id).add(self)
+        else:
+            db.session.add(self)
+
+    @classmethod
+    def _query_for_user(cls, user: UserModel):
+        return router.session_for_user(user.id).query(cls) if router.enabled else cls.query
 
     @classmethod
     def get_by_id(cls, order_id: int):
-        return cls.query.get(order_id)
+        if not router.enabled:
+            return cls.query.get(order_id)
+        session, local_id = router.locate(order_id)
+        return session.query(cls).get(local_id) if session is not None else None
 
     @classmethod
-    def find_valid_by_user(cls, user: UserModel):
-        return cls.query.filter_by(user_id=user.id, is_obsolete=False)
+    def find_by_ids(cls, order_ids):
+        # one IN query for the orders and one for their line items; menus are read per request
+        if not router.enabled:
+            return cls.query.filter(cls.id.in_(order_ids)).options(selectinload(cls.menus)).all()
+
+        options = selectinload(cls.menus)
+        result = list()
+        for session, local_ids in router.group(order_ids).items():
+            result.extend(session.query(cls).filter(cls.id.in_(local_ids)).options(options))
+        return result
+
+    @classmethod
+    def find_recent(cls, limit: int):
+        """Newest valid orders with their line items, across every shard."""
+        options = selectinload(cls.menus)
+        if not router.enabled:
+            return cls.query.filter_by(is_obsolete=False).order_by(cls.id.desc()).options(options).limit(limit).all()
+
+        result = list()
+        for session in router.sessions:
+            result.extend(session.query(cls).filter_by(is_obsolete=False)
+                          .order_by(cls.id.desc()).options(options).limit(limit))
+        result.sort(key=lambda order: order.create_date, reverse=True)
+        return result[:limit]
+
+    @classmethod
+    def find_valid_by_user(cls, user: UserModel, columns=None):
+        query = cls._query_for_user(user).filter_by(user_id=user.id, is_obsolete=False)
+        return query.options(load_only(*columns)) if columns else query
 
     @classmethod
     def find_history_by_user(cls, user: UserModel):
-        return cls.query.filter_by(user_id=user.id, is_obsolete=True)
+        return cls._query_for_user(user).filter_by(user_id=user.id, is_obsolete=True)
 
 
 class SerialNumberModel(db.Model):
@@ -197,33 +368,116 @@ class SerialNumberModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
     menu_id = db.Column(db.Integer, db.ForeignKey('menu.id'), nullable=False)
-    serial_number = db.Column(db.String(255), nullable=False)
-    create_date = db.Column(db.DATETIME, default=datetime.datetime.utcnow())
+    serial_number = db.Column(db.String(255), nullable=False, index=True)
+    create_date = db.Column(db.DATETIME, default=datetime.datetime.utcnow, index=True)
     order = db.relationship('OrderModel', back_populates='serial_number_list')
     menu = db.relationship('MenuModel', back_populates='serials')
 
     def save_to_db(self):
-        db.session.add(self)
-        db.session.commit()
+        # a link created through its order already belongs to that order's (shard) session
+        (object_session(self) or db.session).add(self)
 
     @classmethod
-    def find_duplicate_link(cls, order_id: int, serial_number: str, menu_id: int):
-        return cls.query.filter_by(order_id=order_id, serial_number=serial_number, menu_id=menu_id).first()
+    def find_duplicate_link(cls, order: OrderModel, serial_number: str, menu_id: int):
+        return object_session(order).query(cls) \
+            .filter_by(order_id=order.id, serial_number=serial_number, menu_id=menu_id).first()
 
     @classmethod
     def find_by_order(cls, order: OrderModel):
-        return cls.query.filter_by(order_id=order.id)
+        return object_session(order).query(cls).filter_by(order_id=order.id)
 
     @classmethod
     def get_by_id(cls, serial_id: int):
         return cls.query.get(serial_id)
 
+    @classmethod
+    def find_recent_active(cls, limit: int):
+        """Newest links of valid orders, with their order loaded, across every shard."""
+        sessions = router.sessions if router.enabled else [db.session]
+        result = list()
+        for session in sessions:
+            result.extend(session.query(cls).join(cls.order).filter(OrderModel.is_obsolete.is_(False))
+                          .order_by(cls.id.desc()).options(joinedload(cls.order)).limit(limit))
+        result.sort(key=lambda link: link.create_date, reverse=True)
+        return result[:limit]
+
     @classmethod
     def get_by_serial_number(cls, serial_number: str):
-        db_result = cls.query.filter_by(serial_number=serial_number).first()
+        if not router.enabled:
+            return cls.query.filter_by(serial_number=serial_number).first()
 
-        result = None
-        if db_result:
-            result = db_result
+        # serial numbers carry no user id, so every shard is asked in turn
+        for session in router.sessions:
+            db_result = session.query(cls).filter_by(serial_number=serial_number).first()
+            if db_result:
+                return db_result
+        return None
 
-        return result
+    @classmethod
+    def find_expired(cls, session, cutoff: datetime.datetime, after_id: int, limit: int):
+        """Links of obsoleted orders created before cutoff, in id order after after_id."""
+        return session.query(cls).join(cls.order) \
+            .filter(cls.id > after_id, cls.create_date < cutoff, OrderModel.is_obsolete.is_(True)) \
+            .order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def delete_ids(cls, session, ids):
+        return session.query(cls).filter(cls.id.in_(ids)).delete(synchronize_session=False)
+
+
+class SerialNumberArchiveModel(db.Model):
+    """Serial links removed by `flask compact-serials --archive`; kept next to serial_number."""
+    __tablename__ = 'serial_number_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    source_id = db.Column(db.Integer, nullable=False, index=True)  # id the link had in serial_number
+    order_id = db.Column(db.Integer, nullable=False)
+    menu_id = db.Column(db.Integer, nullable=False)
+    serial_number = db.Column(db.String(255), nullable=False)
+    create_date = db.Column(db.DATETIME)
+    archive_date = db.Column(db.DATETIME, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def archive(cls, session, links):
+        session.bulk_insert_mappings(cls, [{'source_id': link.id, 'order_id': link.order_id, 'menu_id': link.menu_id,
+                                            'serial_number': link.serial_number,
+                                            'create_date': link.create_date} for link in links])
+
+
+router.init_app(app, db, sharded_models=[OrderModel, AssociationModel, SerialNumberModel,
+                                          SerialNumberArchiveModel])
+
+
+class IdempotencyKeyModel(db.Model):
+    __tablename__ = 'idempotency_key'
+    __table_args__ = (db.UniqueConstraint('user_id', 'key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)  # empty while the first request is in flight
+    response = db.Column(db.Text, nullable=True)
+    create_date = db.Column(db.DATETIME, default=datetime.datetime.utcnow)
+    expire_date = db.Column(db.DATETIME, nullable=False, index=True)
+
+    def save_to_db(self):
+        db.session.add(self)
+
+    def delete_from_db(self):
+        db.session.delete(self)
+
+    @classmethod
+    def find_by_user_and_key(cls, user_id: int, key: str):
+        return cls.query.filter_by(user_id=user_id, key=key).first()
+
+    @classmethod
+    def delete_abandoned(cls, record_id: int, started_before: datetime.datetime):
+        """Deletes a claim still without response that was made before started_before."""
+        return cls.query.filter(cls.id == record_id, cls.status_code.is_(None),
+                                cls.create_date <= started_before).delete(synchronize_session=False)
+
+    @classmethod
+    def delete_expired(cls, limit: int = 1000):
+        ids = [row.id for row in db.session.query(cls.id)
+               .filter(cls.expire_date <= datetime.datetime.utcnow()).limit(limit)]
+        if not ids:
+            return 0
+        return cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
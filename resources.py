@@ -1,21 +1,39 @@
 from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, jwt_refresh_token_required,
                                 get_jwt_identity, get_raw_jwt)
+from flask import Response, stream_with_context
 from flask_restful import Resource
-from models import MenuTypes, FoamLevels, SizeLevels, TasteLevels, WaterLevels, Gender, CoffeeOption
+from sqlalchemy.orm import object_session
+from models import MenuTypes, FoamLevels, SizeLevels, TasteLevels, WaterLevels, Gender, CoffeeOption, MENU_FACETS
 from models import UserModel, RevokedTokenModel, MenuModel, OrderModel, AssociationModel, SerialNumberModel
+from models import MenuChangeModel
 import logging
 import datetime
 from webargs.flaskparser import use_args
 from webargs import validate
+from webargs.fields import DelimitedList
 from marshmallow import Schema, fields
+import events
+import unit_of_work
+import load_shedding
+from run import app
+from cache import make_cache
+from idempotency import idempotent
+import warmup
 
 
-logging.basicConfig(datefmt='%m-%d %H:%M',
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    handlers=[logging.StreamHandler()])
-
 logger = logging.getLogger(__name__)
 logger.setLevel(level=logging.INFO)
+serial_logger = logging.getLogger(__name__ + '.serial_number')
+
+# order details; without a shared backend only this worker sees PATCH /order/<id> drop an
+# entry, so other workers may serve an obsoleted order for up to ORDER_CACHE_TTL seconds
+order_cache = make_cache(app.config, 'ORDER_CACHE', maxsize=4096, ttl=5)
+# per-owner menu lists; without a versioned backend, other workers may serve a list up to
+# MENU_CACHE_TTL seconds old after a write
+menu_cache = make_cache(app.config, 'MENU_CACHE', maxsize=1024, ttl=30)
+# serial number lookups; `flask compact-serials` removes links, which without a shared backend
+# other workers notice only after SERIAL_CACHE_TTL seconds
+serial_cache = make_cache(app.config, 'SERIAL_CACHE', maxsize=8192, ttl=60)
 
 
 class OrderSchema(Schema):
@@ -34,6 +52,8 @@ user_args = {
 
 
 class UserRegistration(Resource):
+    method_decorators = [load_shedding.limit('user_registration', 'bulk')]
+
     @use_args(user_args)
     def post(self, args):
         if UserModel.find_by_username(args.get('username')):
@@ -58,6 +78,8 @@ class UserRegistration(Resource):
 
 
 class UserLogin(Resource):
+    method_decorators = [load_shedding.limit('user_login', 'bulk')]
+
     @use_args(user_args)
     def post(self, args):
         current_user = UserModel.find_by_username(args.get('username'))
@@ -77,6 +99,8 @@ class UserLogin(Resource):
 
 
 class UserLogoutAccess(Resource):
+    method_decorators = [load_shedding.limit('user_logout_access', 'normal')]
+
     @jwt_required
     def post(self):
         jti = get_raw_jwt()['jti']
@@ -89,6 +113,8 @@ class UserLogoutAccess(Resource):
 
 
 class UserResetPassword(Resource):
+    method_decorators = [load_shedding.limit('user_reset_password', 'bulk')]
+
     reset_pwd_args = {
         'username': fields.Str(required=True),
         'password': fields.Str(required=True),
@@ -105,7 +131,7 @@ class UserResetPassword(Resource):
         if UserModel.verify_hash(args.get('password'), current_user.password):
             current_user.password = UserModel.generate_hash(args.get('new_password'))
             try:
-                current_user.save_to_db()
+                current_user.revoke_all_tokens()
                 access_token = create_access_token(identity=args.get('username'))
                 refresh_token = create_refresh_token(identity=args.get('username'))
                 return {
@@ -120,6 +146,8 @@ class UserResetPassword(Resource):
 
 
 class UserLogoutRefresh(Resource):
+    method_decorators = [load_shedding.limit('user_logout_refresh', 'normal')]
+
     @jwt_refresh_token_required
     def post(self):
         jti = get_raw_jwt()['jti']
@@ -131,22 +159,65 @@ class UserLogoutRefresh(Resource):
             return {'message': 'Something went wrong'}, 500
 
 
+class UserLogoutAll(Resource):
+    method_decorators = [load_shedding.limit('user_logout_all', 'normal')]
+
+    @jwt_required
+    def post(self):
+        current_user = get_jwt_identity()
+        logged_user = UserModel.find_by_username(current_user)
+        try:
+            logged_user.revoke_all_tokens()
+            return {'message': 'All tokens of user {} have been revoked'.format(current_user)}
+        except (Exception,):
+            return {'message': 'Something went wrong'}, 500
+
+
+def fieldset_args(field_names):
+    """`fields=a,b` query argument restricting a payload to the listed top-level keys."""
+    return {'fields': DelimitedList(fields.Str(validate=validate.OneOf(list(field_names))), missing=None)}
+
+
+def select_fields(payload, selected):
+    if not selected:
+        return payload
+    return {key: value for key, value in payload.items() if key in selected}
+
+
+def columns_for(selected, column_map):
+    """Model columns backing the selected payload keys, for load_only(); None loads everything."""
+    if not selected:
+        return None
+    return [column_map[key] for key in selected if column_map.get(key)]
+
+
 class UserProfileRoute(Resource):
+    method_decorators = [load_shedding.limit('user_id', 'normal')]
+
+    profile_columns = {'username': 'username', 'email': 'email', 'phone': 'phone',
+                       'gender': 'gender', 'birthday': 'birthday'}
+
     @jwt_required
-    def get(self, user_id=None):
+    @use_args(fieldset_args(profile_columns))
+    def get(self, args, user_id=None):
         if not user_id:
             return {'message': 'user not found'}, 404
 
-        user = UserModel.get_by_id(user_id)
+        selected = args.get('fields')
+        user = UserModel.get_by_id(user_id, columns=columns_for(selected, self.profile_columns))
         if user:
-            return {'username': user.username, 'email': user.email,
-                    'phone': user.phone, 'gender': user.gender,
-                    'birthday': str(user.birthday)}
+            payload = dict()
+            for key in self.profile_columns:
+                if not selected or key in selected:
+                    payload[key] = str(user.birthday) if key == 'birthday' else getattr(user, key)
+            return payload
         else:
             return {'message': 'user not found'}, 404
 
 
 class UserProfile(Resource):
+    method_decorators = [load_shedding.limit('user_profile', 'normal')]
+
     profile_args = {
         'gender': fields.Str(required=True, validate=validate.OneOf(Gender.get_enum_labels())),
         'phone': fields.Str(required=True),
@@ -188,6 +259,8 @@ class UserProfile(Resource):
 
 
 class TokenRefresh(Resource):
+    method_decorators = [load_shedding.limit('token_refresh', 'normal')]
+
     @jwt_refresh_token_required
     def get(self):
         current_user = get_jwt_identity()
@@ -195,7 +268,23 @@ class TokenRefresh(Resource):
         return {'access_token': access_token}
 
 
+menu_columns = {'menu_id': 'id', 'name': 'name', 'water_level': 'water_level', 'foam_level': 'foam_level',
+                'taste_level': 'taste_level', 'grind_size': 'grind_size', 'menu_type': 'menu_type',
+                'coffee_option': 'coffee_option'}
+
+
+def menu_to_json(item, selected=None):
+    if selected:
+        return {key: getattr(item, column) for key, column in menu_columns.items() if key in selected}
+    return {'menu_id': item.id, 'name': item.name,
+            'water_level': item.water_level, 'foam_level': item.foam_level,
+            'taste_level': item.taste_level, 'grind_size': item.grind_size,
+            'menu_type': item.menu_type, 'coffee_option': item.coffee_option}
+
+
 class MenuResource(Resource):
+    method_decorators = [load_shedding.limit('menu', 'normal')]
+
     menu_args = {
         'menu_id': fields.Int(required=False),
         'name': fields.Str(required=True),
@@ -223,6 +312,9 @@ class MenuResource(Resource):
                              owner_id=logged_user.id)
         try:
             new_menu.save_to_db()
+            MenuChangeModel.record(new_menu)
+            owner_id = logged_user.id
+            unit_of_work.after_commit(lambda: menu_cache.delete(owner_id))
             return {'message': 'New menu created successfully.'}
         except (Exception,):
             logger.exception('Menu registration failed.')
@@ -249,6 +341,9 @@ class MenuResource(Resource):
                 db_result.foam_level = args.get('foam_level')
                 db_result.grind_size = args.get('grind_size')
                 db_result.save_to_db()
+                MenuChangeModel.record(db_result)
+                owner_id = logged_user.id
+                unit_of_work.after_commit(lambda: menu_cache.delete(owner_id))
                 return {'message': 'menu update successfully.'}
             except (Exception,):
                 logger.exception('Menu update failed.')
@@ -257,47 +352,154 @@ class MenuResource(Resource):
             return {'message': 'menu item not found.'}, 404
 
     @jwt_required
-    def get(self):
+    @use_args(fieldset_args(menu_columns))
+    def get(self, args):
         current_user = get_jwt_identity()
         logged_user = UserModel.find_by_username(current_user)
 
-        db_result = MenuModel.find_by_user(logged_user)
+        selected = args.get('fields')
+        cached = menu_cache.get(logged_user.id)
+        if cached is None:
+            if selected:
+                db_result = MenuModel.find_by_user(logged_user, columns=columns_for(selected, menu_columns))
+                return [menu_to_json(item, selected) for item in db_result]
+            cached = [menu_to_json(item) for item in MenuModel.find_by_user(logged_user)]
+            menu_cache.set(logged_user.id, cached)
+
+        return [select_fields(item, selected) for item in cached]
+
+
+class MenuChangesResource(Resource):
+    method_decorators = [load_shedding.limit('menu_changes', 'normal')]
+
+    changes_args = {
+        'since': fields.Int(missing=0, validate=validate.Range(min=0))
+    }
+
+    @jwt_required
+    @use_args(changes_args)
+    def get(self, args):
+        """Menus upserted and removed since a version; since=0 returns the full menu set.
+
+        The returned version stops before changes younger than MENU_SYNC_SETTLE_SECONDS:
+        a change with a lower version may still be uncommitted, so those are sent again
+        on the next sync instead of risking a gap.
+        """
+        current_user = get_jwt_identity()
+        logged_user = UserModel.find_by_username(current_user)
+
+        since = args.get('since')
+        settle_cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=app.config.get('MENU_SYNC_SETTLE_SECONDS', 5))
+
+        if since:
+            changes = MenuChangeModel.find_since(logged_user, since).all()
+            version = since
+            for change in changes:
+                if change.create_date > settle_cutoff:
+                    break
+                version = change.version
+            changed_ids = list(dict.fromkeys(change.menu_id for change in changes))
+            menus = MenuModel.find_by_owner_and_ids(logged_user, changed_ids).all() if changed_ids else []
+        else:
+            # the full set replaces whatever the client had, so only the version is needed from the log
+            version = MenuChangeModel.settled_version(logged_user, 0, settle_cutoff)
+            changed_ids = list()
+            menus = MenuModel.find_by_user(logged_user).all()
+
+        found_ids = {menu.id for menu in menus}
+        return {'version': version,
+                'upserts': [menu_to_json(menu) for menu in menus],
+                'tombstones': [menu_id for menu_id in changed_ids if menu_id not in found_ids]}
+
+
+class MenuSearchResource(Resource):
+    method_decorators = [load_shedding.limit('menu_search', 'normal')]
+
+    search_args = dict(
+        {facet: DelimitedList(fields.Str(validate=validate.OneOf(labels.get_enum_labels())), missing=[])
+         for facet, labels in MENU_FACETS.items()},
+        prefix=fields.Str(required=False),
+        limit=fields.Int(missing=50, validate=validate.Range(min=1, max=200)),
+        offset=fields.Int(missing=0, validate=validate.Range(min=0))
+    )
+
+    @jwt_required
+    @use_args(search_args)
+    def get(self, args):
+        current_user = get_jwt_identity()
+        logged_user = UserModel.find_by_username(current_user)
+
+        filters = {facet: args.get(facet) for facet in MENU_FACETS}
+        query = MenuModel.search(logged_user, filters, args.get('prefix'))
+        return {'total': query.count(),
+                'menus': [menu_to_json(item) for item in query.limit(args.get('limit')).offset(args.get('offset'))],
+                'facets': MenuModel.facet_counts(logged_user, filters, args.get('prefix'))}
+
+
+def order_line(menu, counts):
+    """One `order_contents` entry; menu may be a MenuModel or a menu row (see asgi.py)."""
+    return {'menu_id': menu.id,
+            'menu_name': menu.name,
+            'coffee_option': menu.coffee_option,
+            'taste_level': menu.taste_level,
+            'water_level': menu.water_level,
+            'foam_level': menu.foam_level,
+            'grind_size': menu.grind_size,
+            'menu_type': menu.menu_type,
+            'counts': counts}
+
+
+def order_payload(order_id, create_date, lines):
+    return {'order_id': order_id, 'order_contents': lines, 'order_date': create_date.strftime("%Y-%m-%d %H:%M:%S")}
 
-        result = list()
-        for item in db_result:
-            result.append(
-                {'menu_id': item.id, 'name': item.name,
-                 'water_level': item.water_level, 'foam_level': item.foam_level,
-                 'taste_level': item.taste_level, 'grind_size': item.grind_size,
-                 'menu_type': item.menu_type, 'coffee_option': item.coffee_option})
-        return result
+
+def shows_obsolete(order_id, is_obsolete):
+    # order 1 has always been served even once obsoleted
+    return is_obsolete and order_id != 1
+
+
+def order_record(order):
+    """What the order cache keeps: only data the order owns, so a menu PATCH can not make it stale."""
+    if shows_obsolete(order.public_id, order.is_obsolete):
+        return {'message': 'order was obsoleted'}, 400
+    return {'order_id': order.public_id, 'order_date': order.create_date.strftime("%Y-%m-%d %H:%M:%S"),
+            'lines': [[line.menu_id, line.counts] for line in order.menus]}, 200
+
+
+def render_orders(records):
+    """Response bodies of cached order records; the menu fields of all of them take one IN query."""
+    menu_ids = {menu_id for body, status in records if status == 200 for menu_id, _ in body['lines']}
+    menus = {menu.id: menu for menu in MenuModel.query.filter(MenuModel.id.in_(menu_ids))} if menu_ids else {}
+
+    result = list()
+    for body, status in records:
+        if status == 200:
+            body = {'order_id': body['order_id'],
+                    'order_contents': [order_line(menus[menu_id], counts) for menu_id, counts in body['lines']],
+                    'order_date': body['order_date']}
+        result.append((body, status))
+    return result
 
 
 class OrderResourceRoute(Resource):
+    method_decorators = [load_shedding.limit('order_id', 'critical')]
+
     def get(self, order_id=None):
         if not order_id:
             return {'message': 'user not found'}, 404
 
-        order = OrderModel.get_by_id(order_id)
-        if order:
-            if order.is_obsolete and order.id != 1:
-                return {'message': 'order was obsoleted'}, 400
-            else:
-                menu_list = list()
-                for menu in order.menus:
-                    menu_list.append({'menu_id': menu.menu.id,
-                                      'menu_name': menu.menu.name,
-                                      'coffee_option': menu.menu.coffee_option,
-                                      'taste_level': menu.menu.taste_level,
-                                      'water_level': menu.menu.water_level,
-                                      'foam_level': menu.menu.foam_level,
-                                      'grind_size': menu.menu.grind_size,
-                                      'menu_type': menu.menu.menu_type,
-                                      'counts': menu.counts})
-                return {'order_id': order.id, 'order_contents': menu_list,
-                        'order_date': order.create_date.strftime("%Y-%m-%d %H:%M:%S")}
-        else:
-            return {'message': 'order not found'}, 404
+        # line items never change after creation, only the obsolete flag does (see patch)
+        cached = order_cache.get(order_id)
+        if cached is None:
+            order = OrderModel.get_by_id(order_id)
+            if not order:
+                return {'message': 'order not found'}, 404
+            cached = order_record(order)
+            order_cache.set(order_id, cached)
+
+        body, status = render_orders([cached])[0]
+        return body, status
 
     def patch(self, order_id=None):
         if not order_id:
@@ -307,19 +509,75 @@ class OrderResourceRoute(Resource):
         if order:
             order.is_obsolete = True
             order.save_to_db()
-            return {'order_id': order.id, 'is_obsoleted': order.is_obsolete}
+            owner_id = order.user_id
+            order_cache.delete(order_id)
+            unit_of_work.after_commit(lambda: order_cache.delete(order_id))
+            unit_of_work.after_commit(lambda: events.publish('order.obsoleted', user_id=owner_id, order_id=order_id))
+            return {'order_id': order_id, 'is_obsoleted': order.is_obsolete}
         else:
             return {'message': 'user not found'}, 404
 
 
+class OrderBatchResource(Resource):
+    method_decorators = [load_shedding.limit('order_batch', 'critical')]
+
+    max_ids = 100
+
+    batch_args = {
+        'ids': DelimitedList(fields.Int(), required=True, validate=validate.Length(min=1, max=max_ids))
+    }
+
+    batch_body_args = {
+        'ids': fields.List(fields.Int(), required=True, validate=validate.Length(min=1, max=max_ids))
+    }
+
+    @staticmethod
+    def load(order_ids):
+        result = dict()
+        missing = list()
+        for order_id in order_ids:
+            cached = order_cache.get(order_id)
+            if cached is None:
+                missing.append(order_id)
+            else:
+                result[order_id] = cached
+
+        if missing:
+            for order in OrderModel.find_by_ids(missing):
+                result[order.public_id] = order_record(order)
+                order_cache.set(order.public_id, result[order.public_id])
+
+        found = [order_id for order_id in order_ids if order_id in result]
+        rendered = dict(zip(found, render_orders([result[order_id] for order_id in found])))
+        orders = dict()
+        for order_id in order_ids:
+            body, status = rendered.get(order_id, ({'message': 'order not found'}, 404))
+            orders[str(order_id)] = dict(body, status=status)
+        return {'orders': orders}
+
+    @use_args(batch_args)
+    def get(self, args):
+        return self.load(list(dict.fromkeys(args.get('ids'))))
+
+    @use_args(batch_body_args)
+    def post(self, args):
+        return self.load(list(dict.fromkeys(args.get('ids'))))
+
+
 class OrderResource(Resource):
+    method_decorators = {'get': [load_shedding.limit('order_list', 'bulk')],
+                         'post': [load_shedding.limit('order_create', 'normal')]}
+
     order_args = {
         'message': fields.Str(required=True),
         'order': fields.Nested(OrderSchema, many=True)
     }
 
+    order_columns = {'order_id': 'id', 'order_date': 'create_date', 'order_contents': None}
+
     @use_args(order_args)
     @jwt_required
+    @idempotent(should_store=lambda body, status: body.get('message') == 'successful')
     def post(self, received_item):
         current_user = get_jwt_identity()
         logged_user = UserModel.find_by_username(current_user)
@@ -331,44 +589,64 @@ class OrderResource(Resource):
 
             for item in received_item.get("order"):
                 found_menu = MenuModel.get_by_id(item.get("menu_id"))
-                a = AssociationModel(counts=item.get("counts"))
-                a.menu = found_menu
+                # linked by id: menus may live in another database than the order (see sharding)
+                a = AssociationModel(menu_id=found_menu.id, counts=item.get("counts"))
                 new_order.menus.append(a)
 
             new_order.save_to_db()
-            result = {"message": "successful"}
+            object_session(new_order).flush()
+            order_id, owner_id = new_order.public_id, new_order.user_id
+            unit_of_work.after_commit(lambda: events.publish('order.created', user_id=owner_id,
+                                                             order_id=order_id))
+            result = {"message": "successful", "order_id": order_id}
         except (Exception,):
             logger.exception("create order failed")
+            unit_of_work.rollback()
             result = {"message": "failed"}
         return result
 
     @jwt_required
-    def get(self):
+    @use_args(fieldset_args(order_columns))
+    def get(self, args):
         current_user = get_jwt_identity()
         logged_user = UserModel.find_by_username(current_user)
 
-        db_result = OrderModel.find_valid_by_user(logged_user)
-
+        selected = args.get('fields')
+        db_result = OrderModel.find_valid_by_user(logged_user, columns=columns_for(selected, self.order_columns))
         result = list()
         for item in db_result:
-            menu_list = list()
-            for menu in item.menus:
-                menu_list.append({'menu_id': menu.menu.id,
-                                  'menu_name': menu.menu.name,
-                                  'taste_level': menu.menu.taste_level,
-                                  'water_level': menu.menu.water_level,
-                                  'foam_level': menu.menu.foam_level,
-                                  'grind_size': menu.menu.grind_size,
-                                  'menu_type': menu.menu.menu_type,
-                                  'coffee_option': menu.menu.coffee_option,
-                                  'counts': menu.counts})
-            result.append({'order_id': item.id, 'order_contents': menu_list,
-                           'order_date': item.create_date.strftime("%Y-%m-%d %H:%M:%S")})
+            payload = {'order_id': item.public_id}
+            if selected and 'order_contents' not in selected:
+                if 'order_date' in selected:
+                    payload['order_date'] = item.create_date.strftime("%Y-%m-%d %H:%M:%S")
+                result.append(select_fields(payload, selected))
+                continue
+
+            payload['order_contents'] = [order_line(menu.menu, menu.counts) for menu in item.menus]
+            if not selected or 'order_date' in selected:
+                payload['order_date'] = item.create_date.strftime("%Y-%m-%d %H:%M:%S")
+            result.append(select_fields(payload, selected))
 
         return result
 
 
+def serial_lookup(serial):
+    return {'serial_number': serial.serial_number, 'customized_message': serial.order.customized_message,
+            'order_id': serial.order.public_id}
+
+
+def serial_payload(serial_number, customized_message):
+    """GET /serial_number?serial_number= body; the cached lookup also keeps the order id for logging."""
+    return {'serial_number': serial_number, 'customized_message': customized_message}
+
+
+def serial_link_payload(serial_number, menu_id, order_id):
+    return {'serial_number': serial_number, 'menu_id': menu_id, 'order_id': order_id}
+
+
 class SerialNumberResource(Resource):
+    method_decorators = [load_shedding.limit('serial_number', 'critical')]
+
     serial_args = {
         'order_id': fields.Int(),
         'menu_id': fields.Int(),
@@ -385,19 +663,28 @@ class SerialNumberResource(Resource):
         order_id = received_link.get("order_id")
         serial_number = received_link.get("serial_number")
         menu_id = received_link.get("menu_id")
-        duplicated = SerialNumberModel.find_duplicate_link(order_id=order_id,
+        order = OrderModel.get_by_id(order_id) if order_id else None
+        if not order:
+            return {"message": "link failed", "reason": "order not found"}
+
+        duplicated = SerialNumberModel.find_duplicate_link(order=order,
                                                            serial_number=serial_number,
                                                            menu_id=menu_id)
 
         if not duplicated:
-            serial_link = SerialNumberModel(order_id=order_id,
+            serial_link = SerialNumberModel(order=order,
                                             serial_number=serial_number,
                                             menu_id=menu_id)
             try:
                 serial_link.save_to_db()
+                owner_id = order.user_id
+                unit_of_work.after_commit(lambda: events.publish('serial_number.linked', user_id=owner_id,
+                                                                 order_id=order_id, menu_id=menu_id,
+                                                                 serial_number=serial_number))
                 result = {"message": "link serial success."}
             except (Exception,):
                 logger.exception("link serial failed")
+                unit_of_work.rollback()
                 result = {"message": "link failed", "reason": "exception raised."}
         else:
             result = {"message": "link failed", "reason": "duplicated link information"}
@@ -416,18 +703,54 @@ class SerialNumberResource(Resource):
             if order:
                 db_result = SerialNumberModel.find_by_order(order=order)
                 for item in db_result:
-                    result.append({'serial_number': item.serial_number, 'menu_id': item.menu.id, 'order_id': item.order.id})
+                    result.append(serial_link_payload(item.serial_number, item.menu_id, order.public_id))
             else:
                 return {'message': 'order_id not found'}, 404
         elif serial_number_str:
-            serial = SerialNumberModel.get_by_serial_number(serial_number=serial_number_str)
-
-            if serial:
-                logging.error(serial.order.customized_message)
-                result = {'serial_number': serial.serial_number, 'customized_message': serial.order.customized_message}
-            else:
-                return {'message': 'serial_number not found'}, 404
+            cached = serial_cache.get(serial_number_str)
+            if cached is None:
+                serial = SerialNumberModel.get_by_serial_number(serial_number=serial_number_str)
+                if not serial:
+                    return {'message': 'serial_number not found'}, 404
+                cached = serial_lookup(serial)
+                serial_cache.set(serial_number_str, cached)
+
+            serial_logger.info('serial number lookup', extra={'serial_number': cached['serial_number'],
+                                                              'order_id': cached['order_id']})
+            result = serial_payload(cached['serial_number'], cached['customized_message'])
         else:
             return {'message': 'order or serial is required.'}, 400
 
         return result
+
+
+class EventStream(Resource):
+    stream_args = {
+        'topics': DelimitedList(fields.Str(validate=validate.OneOf(events.TOPICS)), missing=list(events.TOPICS))
+    }
+
+    @jwt_required
+    @use_args(stream_args)
+    def get(self, args):
+        current_user = get_jwt_identity()
+        logged_user = UserModel.find_by_username(current_user)
+
+        # the slot is held for the whole stream, so it is released when the response is closed
+        slot = load_shedding.limiter('events', 'stream')
+        if not slot.acquire():
+            return load_shedding.busy(slot)
+
+        subscription = events.subscribe(user_id=logged_user.id, topics=args.get('topics'))
+        response = Response(stream_with_context(events.stream(subscription)),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(slot.release)
+        return response
+
+
+class MetricsResource(Resource):
+    # not limited: it must answer while the process sheds everything else
+    def get(self):
+        return {'order_cache': order_cache.stats(), 'menu_cache': menu_cache.stats(),
+                'serial_cache': serial_cache.stats(), 'warmup': warmup.report,
+                'transactions': dict(unit_of_work.stats), 'load_shedding': load_shedding.stats()}
@@ -0,0 +1,112 @@
+"""Optional horizontal sharding of orders by user id.
+
+With ORDER_SHARDS set to a list of database URIs, `order`, `association_model`,
+`serial_number` and `serial_number_archive` rows live on shard `user_id % len(ORDER_SHARDS)`;
+users and menus stay in the main database. Order ids handed to clients encode the shard:
+
+    public id = local id * SLOTS + shard index
+
+so a lookup by id goes straight to one shard. SLOTS is fixed, which caps the layout at
+SLOTS shards; orders that keep their shard across a layout change keep their ids, moved
+ones get new ids (see `flask reshard-orders`). Without ORDER_SHARDS the public id is the
+plain primary key and everything stays in the main database. The shard tables are created
+with the main ones on the first request, or with `flask create-shard-tables`.
+"""
+import sqlalchemy
+from sqlalchemy.orm import object_session, scoped_session, sessionmaker
+import unit_of_work
+
+
+SLOTS = 16
+
+SHARDED_TABLES = ('order', 'association_model', 'serial_number', 'serial_number_archive')
+
+
+def shard_tables(metadata):
+    """Copies of the sharded tables without foreign keys to tables that stay in the main database."""
+    shard_metadata = sqlalchemy.MetaData()
+    for name in SHARDED_TABLES:
+        columns = list()
+        for column in metadata.tables[name].columns:
+            foreign_keys = [sqlalchemy.ForeignKey(key.target_fullname) for key in column.foreign_keys
+                            if key.target_fullname.split('.')[0] in SHARDED_TABLES]
+            columns.append(sqlalchemy.Column(column.name, column.type, *foreign_keys,
+                                             primary_key=column.primary_key, nullable=column.nullable,
+                                             index=column.index,
+                                             default=column.default.arg if column.default is not None else None,
+                                             autoincrement=column.autoincrement))
+        sqlalchemy.Table(name, shard_metadata, *columns)
+    return shard_metadata
+
+
+class ShardRouter:
+    def __init__(self):
+        self.uris = list()
+        self.engines = list()
+        self.sessions = list()
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def init_app(self, app, db, sharded_models):
+        self.uris = list(app.config.get('ORDER_SHARDS') or [])
+        if len(self.uris) > SLOTS:
+            raise ValueError('at most {} order shards are supported'.format(SLOTS))
+
+        with app.app_context():
+            main_engine = db.engine
+
+        for index, uri in enumerate(self.uris):
+            engine = sqlalchemy.create_engine(uri, pool_recycle=3600)
+            # sharded models go to the shard, everything else (users, menus) to the main database
+            factory = sessionmaker(bind=main_engine, binds={model: engine for model in sharded_models},
+                                   info={'shard': index})
+            self.engines.append(engine)
+            self.sessions.append(scoped_session(factory))
+            unit_of_work.enlist(self.sessions[-1])
+
+        @app.teardown_appcontext
+        def remove_shard_sessions(exc):
+            for session in self.sessions:
+                session.remove()
+
+    def create_all(self, metadata):
+        """Creates the sharded tables missing on any shard; migrations only cover the main database."""
+        shard_metadata = shard_tables(metadata)
+        for engine in self.engines:
+            shard_metadata.create_all(engine)
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    def shard_for_user(self, user_id):
+        return user_id % len(self.engines)
+
+    def session_for_user(self, user_id):
+        return self.sessions[self.shard_for_user(user_id)]
+
+    def locate(self, public_id):
+        """(session, local id) of a public order id, or (None, None) for ids of unknown shards."""
+        local_id, shard = divmod(public_id, SLOTS)
+        if shard >= len(self.sessions):
+            return None, None
+        return self.sessions[shard], local_id
+
+    def group(self, public_ids):
+        """Local ids per shard session, for one IN query per shard."""
+        grouped = dict()
+        for public_id in public_ids:
+            session, local_id = self.locate(public_id)
+            if session is not None:
+                grouped.setdefault(session, []).append(local_id)
+        return grouped
+
+    def public_id(self, instance):
+        if not self.enabled:
+            return instance.id
+        return instance.id * SLOTS + object_session(instance).info['shard']
+
+
+router = ShardRouter()
@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# the app reads its configuration at import time, so the test database has to be set first
+_db_fd, _db_path = tempfile.mkstemp(suffix='.db')
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', 'sqlite:///' + _db_path)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from run import app as flask_app, db  # noqa: E402
+import idempotency  # noqa: E402
+import load_shedding  # noqa: E402
+import models  # noqa: E402
+import resources  # noqa: E402
+import unit_of_work  # noqa: E402
+
+# run in a subprocess with ORDER_SHARDS set, see test_sharding.py
+collect_ignore = [] if os.environ.get('ORDER_SHARDS') else ['sharded']
+
+MENU = {'name': 'latte', 'menu_type': 'general', 'coffee_option': 'coffee_A', 'taste_level': 'mild',
+        'water_level': 'long', 'foam_level': 'none', 'grind_size': 'fine'}
+
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+    for cache in (resources.order_cache, resources.menu_cache, resources.serial_cache):
+        cache.clear()
+    models.token_epoch_cache.clear()
+    idempotency.replay_cache = idempotency.ReplayCache()
+    load_shedding.reset()
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def register(client, username='alice', password='secret'):
+    response = client.post('/user/registration', json={'username': username, 'password': password})
+    assert response.status_code == 200, response.get_json()
+    return {'Authorization': 'Bearer ' + response.get_json()['access_token']}
+
+
+@pytest.fixture
+def auth(client):
+    return register(client)
+
+
+def create_menu(client, headers, **values):
+    response = client.post('/menu', json=dict(MENU, **values), headers=headers)
+    assert response.status_code == 200, response.get_json()
+    return max(item['menu_id'] for item in client.get('/menu', headers=headers).get_json())
+
+
+def create_order(client, headers, menu_id, counts=1, message='hello', **extra_headers):
+    response = client.post('/order', json={'message': message, 'order': [{'menu_id': menu_id, 'counts': counts}]},
+                           headers=dict(headers, **extra_headers))
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['order_id']
+
+
+class CommitCounter:
+    """unit_of_work.stats deltas over a block of requests."""
+
+    def __init__(self):
+        self.start = dict(unit_of_work.stats)
+
+    def __getitem__(self, key):
+        return unit_of_work.stats[key] - self.start[key]
+
+
+@pytest.fixture
+def commits():
+    return CommitCounter
@@ -0,0 +1,87 @@
+import pytest
+import sqlalchemy
+from run import db
+from sharding import router, shard_tables, SHARDED_TABLES, SLOTS
+from conftest import create_menu, create_order, register
+
+
+@pytest.fixture(autouse=True)
+def empty_shards(app):
+    yield
+    metadata = shard_tables(db.metadata)
+    for engine in router.engines:
+        if engine.has_table('order'):
+            with engine.begin() as conn:
+                for table in reversed(metadata.sorted_tables):
+                    conn.execute(table.delete())
+
+
+def _rows(shard, table):
+    with router.engines[shard].connect() as conn:
+        return conn.execute(sqlalchemy.text('select count(*) from "{}"'.format(table))).scalar()
+
+
+def test_first_request_creates_the_shard_tables(client):
+    client.get('/metrics')
+    for engine in router.engines:
+        assert set(SHARDED_TABLES) <= set(sqlalchemy.inspect(engine).get_table_names())
+
+
+def test_orders_end_to_end(client):
+    alice, bob = register(client, 'alice'), register(client, 'bob')  # user ids 1 and 2
+    alice_order = create_order(client, alice, create_menu(client, alice), message='for alice')
+    bob_order = create_order(client, bob, create_menu(client, bob), message='for bob')
+
+    # user_id % 2 picks the shard, which the public id carries
+    assert alice_order % SLOTS == 1 and bob_order % SLOTS == 0
+    assert (_rows(0, 'order'), _rows(1, 'order')) == (1, 1)
+    assert (_rows(0, 'association_model'), _rows(1, 'association_model')) == (1, 1)
+
+    detail = client.get('/order/{}'.format(alice_order)).get_json()
+    assert detail['order_id'] == alice_order
+    assert detail['order_contents'][0]['menu_name'] == 'latte'
+    assert [order['order_id'] for order in client.get('/order', headers=bob).get_json()] == [bob_order]
+
+    batch = client.get('/order/batch?ids={},{},{}'.format(alice_order, bob_order, 5 * SLOTS + 9)).get_json()
+    assert batch['orders'][str(alice_order)]['status'] == 200
+    assert batch['orders'][str(bob_order)]['order_id'] == bob_order
+    assert batch['orders'][str(5 * SLOTS + 9)]['status'] == 404
+
+    menu_id = detail['order_contents'][0]['menu_id']
+    link = {'order_id': alice_order, 'menu_id': menu_id, 'serial_number': 'sn-alice'}
+    assert client.post('/serial_number', json=link).get_json() == {'message': 'link serial success.'}
+    assert _rows(1, 'serial_number') == 1 and _rows(0, 'serial_number') == 0
+    assert client.get('/serial_number?serial_number=sn-alice', headers=bob).get_json() == \
+        {'serial_number': 'sn-alice', 'customized_message': 'for alice'}
+    assert client.get('/serial_number?order_id={}'.format(alice_order), headers=alice).get_json()[0]['order_id'] \
+        == alice_order
+
+
+def test_reshard_moves_orders_out_of_the_main_database(app, client):
+    alice, bob = register(client, 'alice'), register(client, 'bob')
+    menu_id = create_menu(client, alice)
+    existing = create_order(client, alice, menu_id)  # takes local id 1 on alice's shard
+
+    tables = db.metadata.tables
+    with db.engine.begin() as conn:
+        for order_id, user_id in ((1, 1), (2, 2)):
+            conn.execute(tables['order'].insert().values(id=order_id, user_id=user_id, is_obsolete=False,
+                                                         customized_message='legacy {}'.format(order_id)))
+            conn.execute(tables['association_model'].insert().values(order_id=order_id,
+                                                                     menu_id=menu_id, counts=order_id))
+        conn.execute(tables['serial_number'].insert().values(order_id=1, menu_id=menu_id, serial_number='legacy'))
+
+    result = app.test_cli_runner().invoke(args=['reshard-orders', '--delete-source'])
+    assert result.exit_code == 0, result.output
+    id_map = dict(tuple(int(value) for value in line.split(',')) for line in result.output.splitlines()
+                  if ',' in line)
+    assert set(id_map) == {1, 2}
+    assert id_map[1] % SLOTS == 1 and id_map[2] % SLOTS == 0
+    assert id_map[1] != existing
+
+    assert client.get('/order/{}'.format(id_map[2])).get_json()['order_contents'][0]['counts'] == 2
+    assert client.get('/order/{}'.format(existing)).get_json()['order_contents'][0]['counts'] == 1
+    assert client.get('/serial_number?serial_number=legacy', headers=bob).get_json()['customized_message'] \
+        == 'legacy 1'
+    with db.engine.connect() as conn:
+        assert conn.execute(sqlalchemy.select([sqlalchemy.func.count()]).select_from(tables['order'])).scalar() == 0
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import pytest
+import asgi
+import events
+from conftest import create_menu, create_order
+
+
+class Client:
+    """Drives asgi.application with raw ASGI messages."""
+
+    def __init__(self, headers=None):
+        self.headers = [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()]
+
+    def scope(self, method, path, query):
+        return {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+                'headers': self.headers + [(b'content-type', b'application/json')]}
+
+    async def request(self, method, path, query='', body=None):
+        messages = [{'type': 'http.request', 'body': json.dumps(body).encode() if body else b''}]
+        sent = list()
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi.application(self.scope(method, path, query), receive, send)
+        return sent[0]['status'], json.loads(b''.join(message.get('body', b'') for message in sent[1:]))
+
+    def __call__(self, method, path, query='', body=None):
+        return asyncio.run(self.request(method, path, query, body))
+
+
+@pytest.fixture(autouse=True)
+def fresh_database():
+    # thread pool and engine are bound to the loop and the database of one test
+    yield
+    asyncio.run(asgi.database.dispose())
+
+
+def test_order_detail_matches_wsgi(client, auth):
+    order_id = create_order(client, auth, create_menu(client, auth))
+    status, payload = Client()('GET', '/order/{}'.format(order_id))
+    assert status == 200
+    assert payload == client.get('/order/{}'.format(order_id)).get_json()
+
+
+def test_serial_link_and_lookup(client, auth):
+    menu_id = create_menu(client, auth)
+    order_id = create_order(client, auth, menu_id, message='for machines')
+    anonymous, authorized = Client(), Client(auth)
+
+    assert anonymous('POST', '/serial_number', body={'order_id': 999, 'menu_id': menu_id, 'serial_number': 'x'})[1] \
+        == {'message': 'link failed', 'reason': 'order not found'}
+    link = {'order_id': order_id, 'menu_id': menu_id, 'serial_number': 'sn1'}
+    assert anonymous('POST', '/serial_number', body=link) == (200, {'message': 'link serial success.'})
+    assert anonymous('POST', '/serial_number', body=link)[1]['reason'] == 'duplicated link information'
+
+    assert anonymous('GET', '/serial_number', 'serial_number=sn1')[0] == 401
+    assert authorized('GET', '/serial_number', 'serial_number=sn1') == \
+        (200, {'serial_number': 'sn1', 'customized_message': 'for machines'})
+
+
+def test_revoked_tokens_are_rejected(client, auth):
+    client.post('/logout/all', headers=auth)
+    assert Client(auth)('GET', '/order')[0] == 401
+
+
+def test_unknown_route_and_method():
+    assert Client()('GET', '/nope')[0] == 404
+    assert Client()('DELETE', '/order/1')[0] == 405
+
+
+def test_event_stream_receives_async_writes(client, auth):
+    menu_id = create_menu(client, auth)
+    order_id = create_order(client, auth, menu_id)
+
+    async def scenario():
+        chunks = list()
+        disconnect = asyncio.Event()
+        got_event = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            chunks.append(message)
+            if b'event: ' in message.get('body', b''):
+                got_event.set()
+
+        stream = asyncio.ensure_future(asgi.application(
+            Client(auth).scope('GET', '/events', 'topics=order'), receive, send))
+        while not events.hub._subscriptions:
+            await asyncio.sleep(0.01)
+
+        await Client().request('PATCH', '/order/{}'.format(order_id))
+        await asyncio.wait_for(got_event.wait(), 5)
+        disconnect.set()
+        await asyncio.wait_for(stream, 5)
+        return chunks
+
+    chunks = asyncio.run(scenario())
+    assert chunks[0]['status'] == 200
+    body = b''.join(message.get('body', b'') for message in chunks[1:]).decode()
+    assert 'event: order.obsoleted' in body
+    assert not events.hub._subscriptions
+
+
+def test_event_stream_rejects_unknown_topics(auth):
+    status, payload = Client(auth)('GET', '/events', 'topics=menu')
+    assert status == 422
+
+
+def test_async_obsolete_drops_the_order_cache_entry(client, auth):
+    menu_id = create_menu(client, auth)
+    create_order(client, auth, menu_id)
+    order_id = create_order(client, auth, menu_id)  # order 1 is never reported as obsoleted
+    assert client.get('/order/{}'.format(order_id)).status_code == 200
+    assert Client()('PATCH', '/order/{}'.format(order_id))[0] == 200
+    assert client.get('/order/{}'.format(order_id)).status_code == 400
@@ -0,0 +1,110 @@
+import multiprocessing
+import time
+import pytest
+from cache import TTLCache, LRUCache, SqliteStore, MmapStore, make_cache
+
+
+def test_ttl_cache_expires_and_evicts():
+    cache = TTLCache(maxsize=2, ttl=0.05)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 3)
+    assert cache.get('a') is None
+    assert cache.get('c') == 3
+    time.sleep(0.06)
+    assert cache.get('c', 'gone') == 'gone'
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set(1, 'one')
+    cache.set(2, 'two')
+    cache.get(1)
+    cache.set(3, 'three')
+    assert cache.get(2) is None
+    assert cache.get(1) == 'one'
+    stats = cache.stats()
+    assert (stats['size'], stats['evictions'], stats['hits'], stats['misses']) == (2, 1, 2, 1)
+    assert stats['bytes'] == len('"one"') + len('"three"')
+
+
+def test_sqlite_store_shares_entries(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    first, second = LRUCache(shared=SqliteStore(path)), LRUCache(shared=SqliteStore(path))
+    first.set('k', {'v': 1})
+    assert second.get('k') == {'v': 1}
+    assert second.stats()['shared_hits'] == 1
+
+    first.delete('k')
+    # the other worker trusts its local copy for local_ttl
+    assert second.get('k') == {'v': 1}
+    second.local_ttl = 0
+    assert second.get('k') is None
+
+
+@pytest.fixture
+def mmap_path(tmp_path):
+    return str(tmp_path / 'cache.mmap')
+
+
+def _workers(path, **kwargs):
+    return LRUCache(shared=MmapStore(path, slots=64, slot_size=256, **kwargs)), \
+        LRUCache(shared=MmapStore(path, slots=64, slot_size=256, **kwargs))
+
+
+def test_mmap_delete_invalidates_every_worker(mmap_path):
+    first, second = _workers(mmap_path)
+    first.set('k', 'v1')
+    assert second.get('k') == 'v1'
+    assert second.get('k') == 'v1'
+    assert second.stats()['hits'] == 1
+
+    first.delete('k')
+    assert second.get('k') is None
+    first.set('k', 'v2')
+    assert second.get('k') == 'v2'
+
+    second.clear()
+    assert first.get('k') is None
+
+
+def test_mmap_drops_a_set_that_raced_a_delete(mmap_path):
+    first, second = _workers(mmap_path)
+    assert first.get('k') is None  # first starts loading k from the database
+    second.delete('k')  # meanwhile another worker changed it
+    first.set('k', 'stale')
+    assert second.get('k') is None
+    assert first.shared.stats()['skipped_sets'] == 1
+
+
+def test_mmap_skips_oversized_values_and_checks_layout(mmap_path):
+    cache = LRUCache(shared=MmapStore(mmap_path, slots=64, slot_size=256))
+    cache.set('big', 'x' * 300)
+    assert cache.shared.get('big') is None
+    assert cache.shared.stats()['oversize'] == 1
+    with pytest.raises(ValueError):
+        MmapStore(mmap_path, slots=32, slot_size=256)
+
+
+def _write_in_child(path):
+    LRUCache(shared=MmapStore(path, slots=64, slot_size=256)).set('child', 'from child')
+
+
+def test_mmap_is_shared_across_processes(mmap_path):
+    cache = LRUCache(shared=MmapStore(mmap_path, slots=64, slot_size=256))
+    process = multiprocessing.get_context('fork').Process(target=_write_in_child, args=(mmap_path,))
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0
+    assert cache.get('child') == 'from child'
+
+
+def test_make_cache_reads_the_config(tmp_path):
+    assert make_cache({}, 'X', maxsize=5, ttl=3).stats()['backend'] == 'local'
+    assert make_cache({}, 'X', ttl=3).local_ttl == 3
+    assert make_cache({'X_SIZE': 7}, 'X').maxsize == 7
+    assert make_cache({'X_SHARED_PATH': str(tmp_path / 'x.db')}, 'X').stats()['backend'] == 'SqliteStore'
+    config = {'X_BACKEND': 'mmap', 'X_SHARED_PATH': str(tmp_path / 'x.mmap'), 'X_SLOTS': 16, 'X_SLOT_SIZE': 512}
+    assert make_cache(config, 'X').stats()['shared']['slots'] == 16
+    with pytest.raises(ValueError):
+        make_cache({'X_BACKEND': 'memcached'}, 'X')
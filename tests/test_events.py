@@ -0,0 +1,63 @@
+import asyncio
+import events
+from conftest import create_menu, create_order
+
+
+def test_hub_delivers_only_matching_events():
+    hub = events.EventHub(maxsize=10)
+    mine = hub.subscribe(user_id=1, topics=['order'])
+    other = hub.subscribe(user_id=2, topics=['order', 'serial_number'])
+
+    hub.dispatch({'type': 'order.created', 'user_id': 1, 'order_id': 5})
+    hub.dispatch({'type': 'serial_number.linked', 'user_id': 1, 'order_id': 5})
+
+    assert mine.get(timeout=0)['order_id'] == 5
+    assert mine.get(timeout=0) is None
+    assert other.get(timeout=0) is None
+
+
+def test_slow_subscriber_drops_events():
+    hub = events.EventHub(maxsize=1)
+    subscription = hub.subscribe(user_id=1, topics=['order'])
+    for order_id in range(3):
+        hub.dispatch({'type': 'order.created', 'user_id': 1, 'order_id': order_id})
+    assert subscription.get(timeout=0)['order_id'] == 0
+    assert hub.dropped == 2
+
+
+def test_stream_formats_events_and_unsubscribes():
+    subscription = events.hub.subscribe(user_id=7, topics=['order'])
+    events.hub.dispatch({'type': 'order.obsoleted', 'user_id': 7, 'order_id': 3})
+    stream = events.stream(subscription, heartbeat=0.01)
+
+    assert next(stream) == 'retry: 3000\n\n'
+    assert next(stream).startswith('event: order.obsoleted\ndata: {')
+    assert next(stream) == ': keep-alive\n\n'
+    stream.close()
+    assert subscription not in events.hub._subscriptions
+
+
+def test_async_subscription_receives_events_from_other_threads():
+    async def scenario():
+        hub = events.EventHub()
+        subscription = hub.subscribe(user_id=1, topics=['order'], loop=asyncio.get_event_loop())
+        event = {'type': 'order.created', 'user_id': 1, 'order_id': 9}
+        await asyncio.get_event_loop().run_in_executor(None, hub.dispatch, event)
+        return await subscription.get(timeout=1), await subscription.get(timeout=0.01)
+
+    received, nothing = asyncio.run(scenario())
+    assert received['order_id'] == 9
+    assert nothing is None
+
+
+def test_handlers_publish_after_commit(client, auth):
+    menu_id = create_menu(client, auth)
+    subscription = events.hub.subscribe(user_id=1, topics=['order', 'serial_number'])
+    try:
+        order_id = create_order(client, auth, menu_id)
+        client.post('/serial_number', json={'order_id': order_id, 'menu_id': menu_id, 'serial_number': 'sn1'})
+        client.patch('/order/{}'.format(order_id))
+        types = [subscription.get(timeout=0)['type'] for _ in range(3)]
+    finally:
+        events.hub.unsubscribe(subscription)
+    assert types == ['order.created', 'serial_number.linked', 'order.obsoleted']
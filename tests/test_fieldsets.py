@@ -0,0 +1,38 @@
+import sqlalchemy
+from run import db
+from conftest import create_menu, create_order
+
+
+def test_menu_fields(client, auth):
+    menu_id = create_menu(client, auth)
+    assert client.get('/menu?fields=menu_id,name', headers=auth).get_json() == [{'menu_id': menu_id, 'name': 'latte'}]
+    assert set(client.get('/menu', headers=auth).get_json()[0]) == \
+        {'menu_id', 'name', 'water_level', 'foam_level', 'taste_level', 'grind_size', 'menu_type', 'coffee_option'}
+
+
+def test_user_fields(client, auth):
+    assert client.get('/user/1?fields=username', headers=auth).get_json() == {'username': 'alice'}
+    assert client.get('/user/1?fields=password', headers=auth).status_code == 422
+
+
+def test_order_fields_skip_line_items(app, client, auth):
+    order_id = create_order(client, auth, create_menu(client, auth))
+    statements = list()
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', record)
+    try:
+        payload = client.get('/order?fields=order_id,order_date', headers=auth).get_json()
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', record)
+
+    assert [set(item) for item in payload] == [{'order_id', 'order_date'}]
+    assert payload[0]['order_id'] == order_id
+    assert not [statement for statement in statements if 'association' in statement]
+
+    full = client.get('/order', headers=auth).get_json()
+    assert full[0]['order_contents'][0]['counts'] == 1
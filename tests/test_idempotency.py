@@ -0,0 +1,103 @@
+import datetime
+import threading
+import time
+from run import db
+from models import OrderModel, IdempotencyKeyModel
+from conftest import create_menu, create_order
+
+
+def _post_order(client, auth, menu_id, key):
+    return client.post('/order', json={'message': 'hi', 'order': [{'menu_id': menu_id, 'counts': 1}]},
+                       headers=dict(auth, **{'Idempotency-Key': key}))
+
+
+def _order_count(app):
+    with app.app_context():
+        return OrderModel.query.count()
+
+
+def test_retry_replays_the_first_response(app, client, auth):
+    menu_id = create_menu(client, auth)
+    first = _post_order(client, auth, menu_id, 'k1')
+    retry = _post_order(client, auth, menu_id, 'k1')
+    assert retry.status_code == 200
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == first.get_json()
+    assert _order_count(app) == 1
+
+
+def _claim(app, key, age):
+    with app.app_context():
+        record = IdempotencyKeyModel(user_id=1, key=key,
+                                     expire_date=datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        record.create_date = datetime.datetime.utcnow() - age
+        db.session.add(record)
+        db.session.commit()
+
+
+def test_recent_claim_without_response_is_in_progress(app, client, auth):
+    menu_id = create_menu(client, auth)
+    _claim(app, 'k2', datetime.timedelta(seconds=1))
+    response = _post_order(client, auth, menu_id, 'k2')
+    assert response.status_code == 409
+    assert response.headers['Retry-After'] == '1'
+    assert _order_count(app) == 0
+
+
+def test_abandoned_claim_is_taken_over(app, client, auth):
+    menu_id = create_menu(client, auth)
+    _claim(app, 'k3', datetime.timedelta(minutes=5))
+    response = _post_order(client, auth, menu_id, 'k3')
+    assert response.status_code == 200
+    assert _order_count(app) == 1
+    assert _post_order(client, auth, menu_id, 'k3').headers['Idempotent-Replayed'] == 'true'
+
+
+def test_rejected_request_releases_the_key(app, client, auth):
+    menu_id = create_menu(client, auth)
+    assert _post_order(client, auth, menu_id + 1, 'k4').get_json() == {'message': 'failed'}
+    assert _post_order(client, auth, menu_id, 'k4').status_code == 200
+
+
+def test_compact_command_deletes_expired_keys(app, client, auth):
+    create_order(client, auth, create_menu(client, auth), **{'Idempotency-Key': 'fresh'})
+    with app.app_context():
+        for index in range(3):
+            db.session.add(IdempotencyKeyModel(user_id=1, key='old{}'.format(index), status_code=200, response='{}',
+                                               expire_date=datetime.datetime.utcnow() - datetime.timedelta(seconds=1)))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['compact-idempotency-keys', '--batch-size', '2', '--pause', '0'])
+    assert result.exit_code == 0, result.output
+    assert '3 expired idempotency key(s) deleted' in result.output
+    with app.app_context():
+        assert [record.key for record in IdempotencyKeyModel.query.all()] == ['fresh']
+
+
+def test_concurrent_duplicate_waits_for_the_commit(app, auth, monkeypatch):
+    menu_id = create_menu(app.test_client(), auth)
+    handler_running = threading.Event()
+    save_to_db = OrderModel.save_to_db
+
+    def slow_save_to_db(self):
+        handler_running.set()
+        time.sleep(0.2)
+        save_to_db(self)
+
+    monkeypatch.setattr(OrderModel, 'save_to_db', slow_save_to_db)
+    responses = dict()
+
+    def post(name):
+        responses[name] = _post_order(app.test_client(), auth, menu_id, 'k5')
+
+    first = threading.Thread(target=post, args=('first',))
+    first.start()
+    assert handler_running.wait(5)
+    post('duplicate')
+    first.join()
+
+    assert responses['first'].status_code == 200
+    assert responses['duplicate'].status_code == 200
+    assert responses['duplicate'].headers['Idempotent-Replayed'] == 'true'
+    assert responses['duplicate'].get_json() == responses['first'].get_json()
+    assert _order_count(app) == 1
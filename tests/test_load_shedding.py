@@ -0,0 +1,69 @@
+import time
+import pytest
+import load_shedding
+from load_shedding import Budget, DEFAULT_PRIORITIES
+
+
+def _ceilings(threads):
+    budget = Budget(threads, DEFAULT_PRIORITIES)
+    return {name: priority_class.ceiling for name, priority_class in budget.classes.items()}
+
+
+def test_classes_share_the_thread_budget():
+    assert _ceilings(8) == {'critical': 8, 'normal': 6, 'bulk': 4, 'stream': 2}
+    # the lower classes always leave a thread to critical
+    assert _ceilings(2) == {'critical': 2, 'normal': 1, 'bulk': 1, 'stream': 1}
+    # a sync worker runs one request at a time anyway
+    assert _ceilings(1) == {'critical': 1, 'normal': 1, 'bulk': 1, 'stream': 1}
+
+
+def test_lower_classes_can_not_take_the_last_threads():
+    budget = Budget(8, DEFAULT_PRIORITIES)
+    assert all(budget.acquire('bulk') for _ in range(4))
+    assert not budget.acquire('bulk')
+    assert budget.acquire('normal') and budget.acquire('normal')
+    assert not budget.acquire('normal')
+    assert budget.acquire('critical') and budget.acquire('critical')
+
+    started = time.monotonic()
+    assert not budget.acquire('critical')
+    assert time.monotonic() - started < 1
+
+    budget.release('bulk')
+    assert budget.acquire('critical')
+    assert budget.stats()['classes']['bulk']['in_flight'] == 3
+
+
+@pytest.fixture
+def two_threads(app):
+    app.config['WORKER_THREADS'] = 2
+    load_shedding.reset()
+    yield
+    app.config.pop('WORKER_THREADS')
+    load_shedding.reset()
+
+
+def test_full_class_is_shed_with_retry_after(client, auth, two_threads):
+    with client.application.app_context():
+        held = load_shedding.limiter('held', 'critical')
+    assert held.acquire()
+
+    response = client.get('/menu', headers=auth)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '2'
+    assert client.get('/serial_number?serial_number=x', headers=auth).status_code == 404
+
+    metrics = client.get('/metrics').get_json()['load_shedding']
+    assert metrics['resources']['menu'] == {'priority': 'normal', 'in_flight': 0, 'admitted': 0, 'shed': 1}
+    held.release()
+    assert client.get('/menu', headers=auth).status_code == 200
+
+
+def test_stream_holds_its_slot_until_closed(client, auth, two_threads):
+    response = client.get('/events', headers=auth)
+    assert response.status_code == 200
+    assert client.get('/events', headers=auth).status_code == 503
+    assert load_shedding.stats()['resources']['events']['in_flight'] == 1
+
+    response.close()
+    assert load_shedding.stats()['budget']['in_flight'] == 0
@@ -0,0 +1,41 @@
+import json
+import logging
+import log_config
+
+
+def _record(name='test', level=logging.INFO, msg='hello %s', args=('world',), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_includes_extra_fields():
+    record = _record(serial_number='sn1', request_id='abc')
+    payload = json.loads(log_config.JsonFormatter().format(record))
+    assert payload['message'] == 'hello world'
+    assert payload['serial_number'] == 'sn1'
+    assert payload['request_id'] == 'abc'
+    assert payload['level'] == 'INFO'
+
+
+def test_sampling_filter_keeps_one_in_n_below_warning():
+    sampling = log_config.SamplingFilter({'sampled': 3})
+    kept = [sampling.filter(_record(name='sampled')) for _ in range(6)]
+    assert kept == [True, False, False, True, False, False]
+    assert sampling.filter(_record(name='sampled', level=logging.WARNING))
+    assert sampling.filter(_record(name='other'))
+
+
+def test_deferred_handler_interpolates_on_the_caller():
+    values = ['before']
+    record = _record(msg='%s', args=(values,))
+    prepared = log_config.DeferredQueueHandler(None).prepare(record)
+    values[0] = 'after'
+    assert prepared.msg == "['before']"
+    assert prepared.args is None
+
+
+def test_request_id_is_taken_from_header_and_echoed(client):
+    response = client.get('/metrics', headers={'X-Request-ID': 'req-42'})
+    assert response.headers['X-Request-ID'] == 'req-42'
+    assert len(client.get('/metrics').headers['X-Request-ID']) == 32
@@ -0,0 +1,106 @@
+import datetime
+from run import db
+from models import MenuChangeModel, UserModel
+from conftest import MENU, create_menu, register
+
+
+def _names(payload):
+    return sorted(menu['name'] for menu in payload['menus'])
+
+
+def _menus(client, auth):
+    create_menu(client, auth, name='latte', taste_level='mild')
+    create_menu(client, auth, name='lungo', taste_level='strong')
+    create_menu(client, auth, name='mocha', taste_level='strong', coffee_option='coffee_B')
+    create_menu(client, register(client, 'bob'), name='latte bob', taste_level='strong')
+
+
+def test_search_filters_and_pages(client, auth):
+    _menus(client, auth)
+    everything = client.get('/menu/search', headers=auth).get_json()
+    assert everything['total'] == 3
+    assert _names(everything) == ['latte', 'lungo', 'mocha']
+
+    strong = client.get('/menu/search?taste_level=strong', headers=auth).get_json()
+    assert _names(strong) == ['lungo', 'mocha']
+    assert _names(client.get('/menu/search?taste_level=mild,strong&prefix=l', headers=auth).get_json()) \
+        == ['latte', 'lungo']
+
+    page = client.get('/menu/search?limit=2&offset=2', headers=auth).get_json()
+    assert page['total'] == 3
+    assert len(page['menus']) == 1
+
+
+def test_facets_ignore_their_own_filter(client, auth):
+    _menus(client, auth)
+    facets = client.get('/menu/search?taste_level=strong', headers=auth).get_json()['facets']
+    # how many menus each taste level would return under the other filters
+    assert facets['taste_level'] == {'mild': 1, 'standard': 0, 'strong': 2}
+    assert facets['coffee_option'] == {'coffee_A': 1, 'coffee_B': 1}
+
+
+def test_search_rejects_unknown_values(client, auth):
+    assert client.get('/menu/search?taste_level=bitter', headers=auth).status_code == 422
+    assert client.get('/menu/search?limit=0', headers=auth).status_code == 422
+
+
+def _sync(client, auth, since):
+    return client.get('/menu/changes?since={}'.format(since), headers=auth).get_json()
+
+
+def test_changes_since_a_version(app, client, auth, monkeypatch):
+    monkeypatch.setitem(app.config, 'MENU_SYNC_SETTLE_SECONDS', 0)
+    first = create_menu(client, auth, name='latte')
+    create_menu(client, auth, name='lungo')
+
+    full = _sync(client, auth, 0)
+    assert full['version'] == 2
+    assert sorted(menu['name'] for menu in full['upserts']) == ['latte', 'lungo']
+    assert _sync(client, auth, 2) == {'version': 2, 'upserts': [], 'tombstones': []}
+
+    client.patch('/menu', json=dict(MENU, menu_id=first, name='flat white'), headers=auth)
+    with app.app_context():
+        # a change of a menu that is gone
+        db.session.add(MenuChangeModel(menu_id=99, owner_id=1))
+        db.session.commit()
+
+    delta = _sync(client, auth, 2)
+    assert delta['version'] == 4
+    assert [menu['name'] for menu in delta['upserts']] == ['flat white']
+    assert delta['tombstones'] == [99]
+
+
+def test_version_stops_before_unsettled_changes(app, client, auth):
+    for name in ('a', 'b', 'c', 'd'):
+        create_menu(client, auth, name=name)
+    now = datetime.datetime.utcnow()
+    with app.app_context():
+        for change in MenuChangeModel.query.all():
+            # version 3 is still young, so version 4 may have overtaken an uncommitted one
+            change.create_date = now if change.version == 3 else now - datetime.timedelta(minutes=1)
+        db.session.commit()
+
+        owner = UserModel.find_by_username('alice')
+        cutoff = now - datetime.timedelta(seconds=5)
+        assert MenuChangeModel.settled_version(owner, 0, cutoff) == 2
+        assert MenuChangeModel.settled_version(owner, 3, cutoff) == 4
+        assert MenuChangeModel.settled_version(owner, 4, cutoff) == 4
+
+    full = _sync(client, auth, 0)
+    assert full['version'] == 2
+    assert len(full['upserts']) == 4
+    assert _sync(client, auth, 2)['version'] == 2
+
+
+def test_compact_keeps_the_latest_change_per_menu(app, client, auth):
+    first = create_menu(client, auth, name='latte')
+    create_menu(client, auth, name='lungo')
+    for name in ('flat white', 'cortado'):
+        client.patch('/menu', json=dict(MENU, menu_id=first, name=name), headers=auth)
+
+    result = app.test_cli_runner().invoke(args=['compact-menu-changes', '--batch-size', '1', '--pause', '0'])
+    assert result.exit_code == 0, result.output
+    assert '2 superseded menu change(s) deleted' in result.output
+    with app.app_context():
+        assert [(change.menu_id, change.version) for change in MenuChangeModel.query.order_by('version')] == \
+            [(first + 1, 2), (first, 4)]
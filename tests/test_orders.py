@@ -0,0 +1,93 @@
+import time
+import sqlalchemy
+from run import db
+from cache import LRUCache
+from resources import order_cache
+from conftest import MENU, create_menu, create_order
+
+
+def _second_order(client, auth):
+    # order 1 is never reported as obsoleted
+    menu_id = create_menu(client, auth)
+    create_order(client, auth, menu_id)
+    return create_order(client, auth, menu_id)
+
+
+def test_obsoleted_order_is_not_served_from_cache(client, auth):
+    order_id = _second_order(client, auth)
+    first = client.get('/order/{}'.format(order_id))
+    assert first.status_code == 200
+    assert order_cache.get(order_id)[0]['order_id'] == order_id
+
+    client.patch('/order/{}'.format(order_id))
+    assert order_cache.get(order_id) is None
+    assert client.get('/order/{}'.format(order_id)).status_code == 400
+
+
+def test_cached_orders_show_the_current_menu(client, auth):
+    order_id = _second_order(client, auth)
+    menu_id = client.get('/order/{}'.format(order_id)).get_json()['order_contents'][0]['menu_id']
+    client.get('/order/batch?ids={}'.format(order_id))
+    assert order_cache.get(order_id) is not None
+
+    client.patch('/menu', json=dict(MENU, menu_id=menu_id, water_level='small'), headers=auth)
+    detail = client.get('/order/{}'.format(order_id)).get_json()
+    assert detail['order_contents'][0]['water_level'] == 'small'
+    batch = client.get('/order/batch?ids={}'.format(order_id)).get_json()
+    assert batch['orders'][str(order_id)] == dict(detail, status=200)
+
+
+def test_local_order_cache_entries_expire():
+    # what bounds a copy held by another worker that did not see the PATCH
+    assert order_cache.local_ttl == 5
+    cache = LRUCache(ttl=0.05)
+    cache.set(1, {'order_id': 1})
+    assert cache.get(1) == {'order_id': 1}
+    time.sleep(0.06)
+    assert cache.get(1) is None
+
+
+def test_batch_reports_every_status(client, auth):
+    menu_id = create_menu(client, auth)
+    first = create_order(client, auth, menu_id)
+    obsoleted = create_order(client, auth, menu_id)
+    client.patch('/order/{}'.format(obsoleted))
+
+    payload = client.get('/order/batch?ids={},{},999,{}'.format(first, obsoleted, first)).get_json()
+    assert list(payload['orders']) == [str(first), str(obsoleted), '999']
+    assert payload['orders'][str(first)] == dict(client.get('/order/{}'.format(first)).get_json(), status=200)
+    assert payload['orders'][str(obsoleted)] == {'message': 'order was obsoleted', 'status': 400}
+    assert payload['orders']['999'] == {'message': 'order not found', 'status': 404}
+
+    posted = client.post('/order/batch', json={'ids': [first, obsoleted, 999]}).get_json()
+    assert posted == payload
+
+
+def test_batch_size_is_limited(client):
+    ids = ','.join(str(order_id) for order_id in range(1, 102))
+    assert client.get('/order/batch?ids=' + ids).status_code == 422
+    assert client.post('/order/batch', json={'ids': []}).status_code == 422
+
+
+def test_batch_query_count_does_not_grow_with_ids(app, client, auth):
+    menu_ids = [create_menu(client, auth, name='menu{}'.format(index)) for index in range(3)]
+    few = [create_order(client, auth, menu_ids[0])]
+    many = [create_order(client, auth, menu_id) for menu_id in menu_ids for _ in range(4)]
+    with app.app_context():
+        engine = db.engine
+
+    def queries(order_ids):
+        statements = list()
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        order_cache.clear()
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            assert client.post('/order/batch', json={'ids': order_ids}).status_code == 200
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        return statements
+
+    assert len(queries(many)) == len(queries(few))
@@ -0,0 +1,87 @@
+import datetime
+import time
+import types
+import commands
+from cache import LRUCache, SqliteStore
+from models import SerialNumberModel, SerialNumberArchiveModel
+from conftest import create_menu, create_order
+
+
+def _link(client, order_id, menu_id, serial_number, obsolete=False):
+    client.post('/serial_number', json={'order_id': order_id, 'menu_id': menu_id, 'serial_number': serial_number})
+    if obsolete:
+        client.patch('/order/{}'.format(order_id))
+    return SerialNumberModel.query.filter_by(serial_number=serial_number).one().id
+
+
+def _boundary():
+    """A moment after the links created so far and before the next ones."""
+    time.sleep(0.01)
+    moment = datetime.datetime.utcnow()
+    time.sleep(0.01)
+    return moment
+
+
+def _compact(app, monkeypatch, now, *args):
+    """Runs compact-serials --days 30 with `now` as the current time."""
+    clock = type('Clock', (datetime.datetime,), {'utcnow': classmethod(lambda cls: now)})
+    monkeypatch.setattr(commands, 'datetime', types.SimpleNamespace(datetime=clock, timedelta=datetime.timedelta))
+    result = app.test_cli_runner().invoke(args=['compact-serials', '--days', '30', '--pause', '0'] + list(args))
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def _month_later():
+    return datetime.datetime.utcnow() + datetime.timedelta(days=31)
+
+
+def test_compact_archives_old_links_of_obsoleted_orders(app, client, auth, monkeypatch):
+    menu_id = create_menu(client, auth)
+    orders = [create_order(client, auth, menu_id) for _ in range(4)]
+    with app.app_context():
+        _link(client, orders[0], menu_id, 'active')
+        expired = _link(client, orders[1], menu_id, 'expired', obsolete=True)
+        boundary = _boundary()
+        recent = _link(client, orders[2], menu_id, 'recent', obsolete=True)
+
+    assert '1 serial link(s) archived' in _compact(app, monkeypatch, boundary + datetime.timedelta(days=30),
+                                                   '--archive')
+    with app.app_context():
+        assert sorted(link.serial_number for link in SerialNumberModel.query) == ['active', 'recent']
+        archived = SerialNumberArchiveModel.query.one()
+        assert (archived.source_id, archived.serial_number, archived.order_id) == (expired, 'expired', orders[1])
+
+    _compact(app, monkeypatch, _month_later(), '--archive')
+    with app.app_context():
+        # SQLite hands out the removed ids again; their next archive must not collide
+        assert _link(client, orders[3], menu_id, 'reused', obsolete=True) == expired
+    _compact(app, monkeypatch, _month_later(), '--archive')
+    with app.app_context():
+        assert [row.source_id for row in SerialNumberArchiveModel.query] == [expired, recent, expired]
+
+
+def test_compact_delete_batches_without_archive(app, client, auth, monkeypatch):
+    menu_id = create_menu(client, auth)
+    with app.app_context():
+        for index in range(5):
+            _link(client, create_order(client, auth, menu_id), menu_id, 'sn{}'.format(index), obsolete=True)
+
+    output = _compact(app, monkeypatch, _month_later(), '--delete', '--batch-size', '2')
+    assert '5 serial link(s) deleted' in output
+    assert '--from-shard 0 --after-id' in output
+    with app.app_context():
+        assert SerialNumberModel.query.count() == 0
+        assert SerialNumberArchiveModel.query.count() == 0
+
+
+def test_compact_drops_shared_cache_entries(app, client, auth, tmp_path, monkeypatch):
+    shared = LRUCache(shared=SqliteStore(str(tmp_path / 'serials.db')))
+    monkeypatch.setattr(commands, 'serial_cache', shared)
+    menu_id = create_menu(client, auth)
+    create_order(client, auth, menu_id)
+    with app.app_context():
+        _link(client, create_order(client, auth, menu_id), menu_id, 'cached', obsolete=True)
+    shared.set('cached', {'serial_number': 'cached'})
+
+    _compact(app, monkeypatch, _month_later())
+    assert LRUCache(shared=SqliteStore(str(tmp_path / 'serials.db'))).get('cached') is None
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+import tempfile
+from sharding import ShardRouter, SLOTS
+
+
+class FakeSession:
+    def __init__(self, shard):
+        self.info = {'shard': shard}
+
+
+def _router(shards):
+    router = ShardRouter()
+    router.engines = [object()] * shards
+    router.sessions = [FakeSession(shard) for shard in range(shards)]
+    return router
+
+
+def test_public_ids_encode_the_shard():
+    router = _router(3)
+    assert router.shard_for_user(7) == 1
+    assert router.locate(5 * SLOTS + 2) == (router.sessions[2], 5)
+    assert router.locate(5 * SLOTS + 3) == (None, None)
+    assert router.group([SLOTS, 2 * SLOTS, SLOTS + 1, SLOTS + 9]) == \
+        {router.sessions[0]: [1, 2], router.sessions[1]: [1]}
+
+
+def test_two_sqlite_shards_end_to_end():
+    tests = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        shards = ','.join('sqlite:///' + os.path.join(directory, 'shard{}.db'.format(index)) for index in range(2))
+        env = dict(os.environ, ORDER_SHARDS=shards, TEST_DATABASE_URL='sqlite:///' + os.path.join(directory, 'main.db'))
+        result = subprocess.run([sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider',
+                                 os.path.join(tests, 'sharded')], env=env, cwd=os.path.dirname(tests),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    assert result.returncode == 0, result.stdout
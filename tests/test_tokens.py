@@ -0,0 +1,65 @@
+from models import UserModel, token_epoch_cache
+
+
+def _tokens(client, password='secret'):
+    response = client.post('/login', json={'username': 'alice', 'password': password})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def _login(client, password='secret'):
+    return {'Authorization': 'Bearer ' + _tokens(client, password)['access_token']}
+
+
+def _refresh(client, refresh_token):
+    return client.get('/token/refresh', headers={'Authorization': 'Bearer ' + refresh_token})
+
+
+def _revoke_and_fail():
+    UserModel.find_by_username('alice').revoke_all_tokens()
+    UserModel.get_token_epoch('alice')
+    return {'message': 'failed after revoking'}, 400
+
+
+def test_logout_all_rejects_older_tokens(client, auth):
+    assert client.post('/logout/all', headers=auth).status_code == 200
+    assert client.get('/order', headers=auth).status_code == 401
+    assert client.get('/order', headers=_login(client)).status_code == 200
+
+
+def test_refresh_tokens_issued_after_logout_all_are_accepted(client, auth):
+    old = _tokens(client)['refresh_token']
+    client.post('/logout/all', headers=auth)
+    assert _refresh(client, old).status_code == 401
+
+    response = _refresh(client, _tokens(client)['refresh_token'])
+    assert response.status_code == 200
+    access = {'Authorization': 'Bearer ' + response.get_json()['access_token']}
+    assert client.get('/order', headers=access).status_code == 200
+
+
+def test_refresh_token_from_a_password_reset_is_accepted(client, auth):
+    old = _tokens(client)['refresh_token']
+    response = client.post('/user/reset_password', json={'username': 'alice', 'password': 'secret',
+                                                         'new_password': 'changed'}, headers=auth)
+    assert response.status_code == 200, response.get_json()
+    assert _refresh(client, old).status_code == 401
+    assert _refresh(client, response.get_json()['refresh_token']).status_code == 200
+
+
+def test_new_tokens_carry_the_stored_epoch_despite_a_stale_cache(client, auth):
+    client.post('/logout/all', headers=auth)
+    # what another worker may still hold within TOKEN_EPOCH_CACHE_TTL
+    token_epoch_cache.set('alice', 0)
+    headers = _login(client)
+    token_epoch_cache.clear()
+    assert client.get('/order', headers=headers).status_code == 200
+
+
+def test_uncommitted_epoch_is_not_cached(app, client, auth):
+    if '/_test/revoke' not in {rule.rule for rule in app.url_map.iter_rules()}:
+        app.add_url_rule('/_test/revoke', '_revoke_and_fail', _revoke_and_fail)
+
+    assert client.get('/_test/revoke').status_code == 400
+    assert token_epoch_cache.get('alice') in (None, 0)
+    assert client.get('/order', headers=auth).status_code == 200
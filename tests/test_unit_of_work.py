@@ -0,0 +1,104 @@
+from flask import request
+from models import UserModel
+import unit_of_work
+from conftest import MENU, create_menu, create_order
+
+calls = list()
+
+
+def _callback_view():
+    unit_of_work.after_commit(lambda: calls.append('after_commit'))
+    unit_of_work.on_failure(lambda: calls.append('on_failure'))
+    if request.args.get('duplicate'):
+        # fails only when the request transaction is committed
+        UserModel(username='alice', password='x').save_to_db()
+    return {'ok': True}, int(request.args.get('status', 200))
+
+
+def _savepoint_view():
+    UserModel(username='kept', password='x').save_to_db()
+    try:
+        with unit_of_work.savepoint():
+            UserModel(username='dropped', password='x').save_to_db()
+            raise ValueError('fail inside the savepoint')
+    except ValueError:
+        pass
+    return {'ok': True}
+
+
+def _route(app, rule, view):
+    if rule not in {r.rule for r in app.url_map.iter_rules()}:
+        app.add_url_rule(rule, view.__name__, view)
+
+
+def test_menu_post_commits_once(client, auth, commits):
+    counter = commits()
+    response = client.post('/menu', json=MENU, headers=auth)
+    assert response.status_code == 200
+    assert counter['commits'] == 1
+    assert counter['rollbacks'] == 0
+
+
+def test_order_patch_commits_once(client, auth, commits):
+    order_id = create_order(client, auth, create_menu(client, auth))
+    counter = commits()
+    response = client.patch('/order/{}'.format(order_id))
+    assert response.get_json() == {'order_id': order_id, 'is_obsoleted': True}
+    assert counter['commits'] == 1
+
+
+def test_client_error_rolls_back_without_commit(client, auth, commits):
+    counter = commits()
+    response = client.patch('/menu', json=MENU, headers=auth)  # no menu_id
+    assert response.status_code == 400
+    assert counter['commits'] == 0
+    assert counter['rollbacks'] == 1
+
+
+def test_order_post_without_key_commits_once(client, auth, commits):
+    menu_id = create_menu(client, auth)
+    counter = commits()
+    create_order(client, auth, menu_id)
+    assert counter['commits'] == 1
+
+
+def test_idempotency_claim_adds_one_commit(client, auth, commits):
+    menu_id = create_menu(client, auth)
+    counter = commits()
+    create_order(client, auth, menu_id, **{'Idempotency-Key': 'k1'})
+    assert counter['commits'] == 2
+
+
+def test_after_commit_runs_only_on_commit(app, client):
+    _route(app, '/_test/callbacks', _callback_view)
+    del calls[:]
+    assert client.get('/_test/callbacks').status_code == 200
+    assert calls == ['after_commit']
+
+    del calls[:]
+    assert client.get('/_test/callbacks?status=409').status_code == 409
+    assert calls == ['on_failure']
+
+
+def test_failed_commit_returns_500_and_runs_failure_callbacks(app, client, auth, commits):
+    _route(app, '/_test/callbacks', _callback_view)
+    del calls[:]
+    counter = commits()
+    response = client.get('/_test/callbacks?duplicate=1')
+    assert response.status_code == 500
+    assert calls == ['on_failure']
+    assert counter['failed_commits'] == 1
+
+
+def test_savepoint_rolls_back_only_its_block(app, client):
+    _route(app, '/_test/savepoint', _savepoint_view)
+    assert client.get('/_test/savepoint').status_code == 200
+    with app.app_context():
+        assert {user.username for user in UserModel.query} == {'kept'}
+
+
+def test_after_commit_outside_request_runs_at_once(app):
+    ran = list()
+    with app.app_context():
+        unit_of_work.after_commit(lambda: ran.append(True))
+    assert ran == [True]
@@ -0,0 +1,71 @@
+import time
+import warmup
+import resources
+from run import db
+from models import OrderModel
+from conftest import create_menu, create_order
+
+
+def _fill(client, auth):
+    menu_id = create_menu(client, auth)
+    order_id = create_order(client, auth, menu_id)
+    client.post('/serial_number', json={'order_id': order_id, 'menu_id': menu_id, 'serial_number': 'sn1'})
+    for cache in (resources.order_cache, resources.menu_cache, resources.serial_cache):
+        cache.clear()
+    return order_id
+
+
+def test_warmup_fills_the_caches(app, client, auth):
+    order_id = _fill(client, auth)
+    report = warmup.run(app)
+
+    assert report['completed'] is True
+    assert [name for name in report['stages']] == ['orders', 'serials', 'menus']
+    assert all(stage['loaded'] == stage['available'] == 1 for stage in report['stages'].values())
+    assert resources.order_cache.get(order_id)[0]['order_id'] == order_id
+    assert resources.serial_cache.get('sn1')['customized_message'] == 'hello'
+    assert resources.menu_cache.get(1)[0]['name'] == 'latte'
+    assert client.get('/metrics').get_json()['warmup'] == report
+
+
+def test_failed_or_skipped_stages_are_not_completed(app, monkeypatch):
+    def failing(resources, target, deadline, state):
+        raise RuntimeError('database is down')
+
+    def slow(resources, target, deadline, state):
+        time.sleep(0.05)
+        return 0, 0
+
+    monkeypatch.setattr(warmup, 'STAGES', (('failing', failing, None),))
+    report = warmup.run(app)
+    assert report['stages'] == {'failing': {'failed': True}}
+    assert report['completed'] is False
+
+    monkeypatch.setitem(app.config, 'WARMUP_SECONDS', 0.01)
+    monkeypatch.setattr(warmup, 'STAGES', (('slow', slow, None), ('never', slow, None)))
+    report = warmup.run(app)
+    assert report['stages']['never'] == {'skipped': True}
+    assert report['completed'] is False
+
+
+def test_warmup_can_be_turned_off(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'WARMUP_SECONDS', 0)
+    monkeypatch.setattr(warmup, 'STAGES', ())
+    assert warmup.run(app) is warmup.report
+
+
+def test_warmed_serial_lookups_expire(app, client, auth, monkeypatch):
+    order_id = _fill(client, auth)
+    assert resources.serial_cache.local_ttl == 60
+    monkeypatch.setattr(resources.serial_cache, 'local_ttl', 0.05)
+    warmup.run(app)
+    with app.app_context():
+        OrderModel.get_by_id(order_id).customized_message = 'changed'
+        db.session.commit()
+
+    def lookup():
+        return client.get('/serial_number?serial_number=sn1', headers=auth).get_json()['customized_message']
+
+    assert lookup() == 'hello'
+    time.sleep(0.06)
+    assert lookup() == 'changed'
@@ -0,0 +1,119 @@
+"""Request-scoped transactions.
+
+`save_to_db` only stages rows in the session; the whole request is committed once after the
+handler returns a response below 400, and rolled back otherwise. Work that must only happen
+once the data is durable (events, cache invalidation) is registered with `after_commit`.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from flask import g, has_request_context, jsonify
+from sqlalchemy import event
+from run import db
+
+
+logger = logging.getLogger(__name__)
+
+# extra sessions (e.g. order shards) committed and rolled back together with db.session
+participants = list()
+
+_stats_lock = threading.Lock()
+stats = {'requests': 0, 'commits': 0, 'rollbacks': 0, 'failed_commits': 0, 'max_commits_per_request': 0}
+
+
+def enlist(session):
+    participants.append(session)
+
+
+def commit():
+    """Participants first, so data the main database refers to is durable before it is."""
+    for session in participants:
+        session.commit()
+    db.session.commit()
+
+
+def rollback():
+    for session in participants:
+        session.rollback()
+    db.session.rollback()
+
+
+def after_commit(callback):
+    """Runs callback once the request transaction is committed; right away outside a request."""
+    if has_request_context():
+        g.setdefault('uow_after_commit', []).append(callback)
+    else:
+        callback()
+
+
+def on_failure(callback):
+    """Runs callback after the request transaction was rolled back; it may commit on its own."""
+    if has_request_context():
+        g.setdefault('uow_on_failure', []).append(callback)
+
+
+@contextmanager
+def savepoint():
+    """Nested transaction: rolls back only the work done inside the block when it raises."""
+    nested = db.session.begin_nested()
+    try:
+        yield
+    except (Exception,):
+        nested.rollback()
+        raise
+    nested.commit()
+
+
+def _run(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except (Exception,):
+            logger.exception('unit of work callback failed')
+
+
+def _count(key, value=1):
+    with _stats_lock:
+        stats[key] += value
+
+
+def _rollback():
+    rollback()
+    _count('rollbacks')
+    _run(g.pop('uow_on_failure', []))
+
+
+def init_app(app):
+    @event.listens_for(db.session, 'after_commit')
+    def count_commit(session):
+        if has_request_context():
+            g.uow_commits = g.get('uow_commits', 0) + 1
+
+    @app.after_request
+    def commit_request(response):
+        g.uow_done = True
+        if response.status_code >= 400:
+            _rollback()
+        else:
+            try:
+                commit()
+            except (Exception,):
+                logger.exception('request commit failed')
+                _count('failed_commits')
+                _rollback()
+                response = jsonify({'message': 'Something went wrong'})
+                response.status_code = 500
+            else:
+                _run(g.pop('uow_after_commit', []))
+
+        commits = g.get('uow_commits', 0)
+        with _stats_lock:
+            stats['requests'] += 1
+            stats['commits'] += commits
+            stats['max_commits_per_request'] = max(stats['max_commits_per_request'], commits)
+        return response
+
+    @app.teardown_request
+    def rollback_request(exc):
+        if exc is not None and not g.get('uow_done'):
+            _rollback()
@@ -0,0 +1,114 @@
+"""Cache warm-up for freshly started workers.
+
+Gunicorn runs `run()` in every worker before it takes requests (see post_worker_init in
+gunicorn.conf.py), so a deploy does not send the first minutes of order, serial and menu
+lookups to the database. Stages run in order until WARMUP_SECONDS is spent; the budget is
+checked between stages and between cache entries, and stages it does not reach are skipped.
+WARMUP_SECONDS = 0 turns warm-up off. The outcome is logged and kept in `report` for /metrics.
+"""
+import logging
+import time
+from models import MenuModel, OrderModel, SerialNumberModel
+
+
+logger = logging.getLogger(__name__)
+
+report = {'enabled': False}
+
+
+def _orders(resources, target, deadline, state):
+    target = min(target, resources.order_cache.maxsize)
+    loaded = 0
+    # the owners of the most recent orders are the ones about to read their menus
+    state['owner_ids'] = owner_ids = list()
+    orders = OrderModel.find_recent(target)
+    for order in orders:
+        if time.monotonic() >= deadline:
+            break
+        resources.order_cache.set(order.public_id, resources.order_record(order))
+        if order.user_id not in owner_ids:
+            owner_ids.append(order.user_id)
+        loaded += 1
+    return loaded, len(orders)
+
+
+def _serials(resources, target, deadline, state):
+    target = min(target, resources.serial_cache.maxsize)
+    loaded = 0
+    links = SerialNumberModel.find_recent_active(target)
+    for link in links:
+        if time.monotonic() >= deadline:
+            break
+        resources.serial_cache.set(link.serial_number, resources.serial_lookup(link))
+        loaded += 1
+    return loaded, len(links)
+
+
+def _menus(resources, target, deadline, state):
+    owner_ids = state.get('owner_ids', [])[:min(target, resources.menu_cache.maxsize)]
+
+    menus = {owner_id: [] for owner_id in owner_ids}
+    for menu in MenuModel.find_by_owner_ids(owner_ids):
+        menus[menu.owner_id].append(resources.menu_to_json(menu))
+
+    loaded = 0
+    for owner_id, menu_list in menus.items():
+        if time.monotonic() >= deadline:
+            break
+        resources.menu_cache.set(owner_id, menu_list)
+        loaded += 1
+    return loaded, len(owner_ids)
+
+
+STAGES = (
+    ('orders', _orders, 'WARMUP_ORDERS'),
+    ('serials', _serials, 'WARMUP_SERIALS'),
+    ('menus', _menus, 'WARMUP_MENU_OWNERS'),
+)
+
+DEFAULT_TARGETS = {'WARMUP_ORDERS': 1000, 'WARMUP_SERIALS': 1000, 'WARMUP_MENU_OWNERS': 200}
+
+
+def run(app):
+    """Fills the worker's caches within the WARMUP_SECONDS budget and returns the report.
+
+    Per stage, `available` counts the rows found for the configured target and `coverage`
+    the share of them that made it into the cache before the deadline.
+    """
+    import resources  # resources imports this module for /metrics
+
+    budget = app.config.get('WARMUP_SECONDS', 5)
+    if not budget:
+        return report
+
+    start = time.monotonic()
+    deadline = start + budget
+    stages = dict()
+    state = dict()
+    with app.app_context():
+        for name, stage, target_key in STAGES:
+            if time.monotonic() >= deadline:
+                stages[name] = {'skipped': True}
+                continue
+
+            stage_start = time.monotonic()
+            target = app.config.get(target_key, DEFAULT_TARGETS.get(target_key))
+            try:
+                loaded, available = stage(resources, target, deadline, state)
+            except (Exception,):
+                logger.exception('cache warm-up stage %s failed', name)
+                stages[name] = {'failed': True}
+                continue
+
+            stages[name] = {'loaded': loaded, 'available': available,
+                            'coverage': round(loaded / available, 4) if available else None,
+                            'seconds': round(time.monotonic() - stage_start, 4)}
+
+    report.clear()
+    report.update({'enabled': True, 'budget_seconds': budget,
+                   'duration_seconds': round(time.monotonic() - start, 4),
+                   'completed': all(not stage.get('skipped') and not stage.get('failed')
+                                    and stage['loaded'] == stage['available'] for stage in stages.values()),
+                   'stages': stages})
+    logger.info('cache warm-up finished', extra={'warmup': report})
+    return report